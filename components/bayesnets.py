@@ -1,12 +1,13 @@
 import math
 import abc
 from collections import defaultdict
+from contextlib import contextmanager
 
 import torch
 import torch.nn as nn
 
 from components.latent_variables import BaseLatentVariable, Categorical, Gaussian
-from components.links import BaseLink
+from components.links import BaseLink, NamedLink, SequentialLink
 
 from time import time
 
@@ -43,24 +44,30 @@ class BayesNet(nn.Module):
         self.log_proba = {lv: None for lv in self.variables}
 
         self.iw = any([lv.iw for lv in self.variables])
-        if self.iw:
-            # Building duplication levels with regard to importance weighted variables
-            self.dp_lvl = {}
-            for lv in self.variables:
-                lvl = 0
-                if lv in self.parent:
-                    lvl = max([self._get_max_iw_path(p, lvl) for p in self.parent[lv]])
-                self.dp_lvl[lv] = lvl
-        else:
-            self.dp_lvl = {lv: 0 for lv in self.variables}
+        # Static graph metadata: the variables without parents, and the duplication levels with regard to importance
+        # weighted variables, memoized for each set of variables forced to be importance weighted (see _get_dp_lvl)
+        self.roots = [lv for lv in self.child.keys() if lv not in self.parent]
+        self.dp_lvls = {}
+        self.dp_lvl = self._get_dp_lvl(None)
+        # Execution plans of the forward pass, compiled once per signature (see _compile_plan)
+        self.plans = {}
 
-    def _get_max_iw_path(self, lv, lvl, force_lv=None):
-        if (lv.iw and force_lv is None) or (force_lv and lv.name in force_lv):
-            lvl += 1
-        if lv not in self.parent:
-            return lvl
-        else:
-            return max([self._get_max_iw_path(p, lvl, force_lv=force_lv) for p in self.parent[lv]])
+    def _get_dp_lvl(self, force_iw):
+        # The duplication level of a variable is the largest number of importance weighted variables on a path from a
+        # root to one of its parents
+        key = frozenset(force_iw) if force_iw else None
+        if key not in self.dp_lvls:
+            iw_path = {}
+
+            def get_iw_path(lv):
+                if lv not in iw_path:
+                    is_iw = (lv.iw and key is None) or (key is not None and lv.name in key)
+                    iw_path[lv] = int(is_iw) + max([get_iw_path(p) for p in self.parent[lv]]
+                                                   if lv in self.parent else [0])
+                return iw_path[lv]
+            self.dp_lvls[key] = {lv: max([get_iw_path(p) for p in self.parent[lv]]) if lv in self.parent else 0
+                                 for lv in self.variables}
+        return self.dp_lvls[key]
 
     def clear_values(self):
         self.variables_hat = {}
@@ -69,22 +76,27 @@ class BayesNet(nn.Module):
         for var in self.variables:
             var.clear_values()
 
+    @contextmanager
+    def recording_attention(self):
+        # Within this context, the links that support it record their cross-attention weights in att_vals during the
+        # forward passes
+        links = [l for l in self.approximator.values() if hasattr(l, 'record_att')]
+        for l in links:
+            l.record_att = True
+        try:
+            yield
+        finally:
+            for l in links:
+                l.record_att = False
+
     def forward(self, inputs, n_iw=None, target=None, eval=False, prev_states=None, force_iw=None, complete=False,
-                lens=None, plant_posteriors=None):
+                lens=None, plant_posteriors=None, incremental=False):
         # The forward pass propagates the root variable values yielding
+        # With incremental=True, links that support it only receive the new positions of sequential inputs, and carry
+        # their cached state for the previous positions through prev_states (e.g. for autoregressive generation).
         if prev_states is None:
             prev_states = {v: None for v in self.variables}
 
-        # Getting current duplication levels
-        if force_iw:
-            dp_lvl = {}
-            for lv in self.variables:
-                lvl = 0
-                if lv in self.parent:
-                    lvl = max([self._get_max_iw_path(p, lvl, force_iw) for p in self.parent[lv]])
-                dp_lvl[lv] = lvl
-        else:
-            dp_lvl = self.dp_lvl
         # Loading the inputs into the network
         self.clear_values()
         if plant_posteriors is not None:
@@ -108,85 +120,74 @@ class BayesNet(nn.Module):
             if plant_posteriors is not None and lv.name in plant_posteriors and lv.post_log_probas is None:
                 lv.post_log_probas = lv.post_log_prob(self.variables_star[lv])
                 self.log_proba[lv] = lv.post_log_probas
-        if target is not None:
-            # Collecting requirements to estimate the target
-            lvs_to_fill = [target]
-            collected = False
-            while not collected:
-                collected = True
-                for lv in lvs_to_fill:
-                    for p in self.parent[lv]:
-                        if (p not in lvs_to_fill) and (p not in self.variables_star):
-                            collected = False
-                            lvs_to_fill.append(p)
-        else:
-            lvs_to_fill = self.parent.keys()
 
-        # Ancestral sampling from the network
-        while any([lv not in self.variables_hat for lv in lvs_to_fill]):
-            # Going through all the unfilled child variables
-            for lv in lvs_to_fill:
-                parents_available = all([(p in self.variables_star) or (p in self.variables_hat)
-                                         for p in self.parent[lv]])
-                still_unfilled = lv not in self.variables_hat
-                if parents_available and still_unfilled:
-                    # Gathering conditioning variables
-                    max_cond_lvl = dp_lvl[lv]
-                    lv_conditions = {p.name: self._ready_condition(p, n_iw, max_cond_lvl, prev_states, dp_lvl, force_iw,
-                                                                   eval)
-                                     for p in self.parent[lv]}
-
-                    # Setting up ground truth to be injected if any
-                    gt_lv = self.variables_star[lv] if lv in self.variables_star else None
-
-                    # Repeating inputs if the latent variable is importance weighted
-                    if ((lv.iw and force_iw is None) or (force_iw and lv.name in force_iw)) and n_iw is not None:
-                        for k, v in lv_conditions.items():
-                            expand_arg = [n_iw]+list(v.shape)
-                            lv_conditions[k] = v.unsqueeze(0).expand(expand_arg)
-                        if gt_lv is not None:
-                            expand_arg = [n_iw]+list(gt_lv.shape)
-                            gt_lv = gt_lv.unsqueeze(0).expand(expand_arg)
-                            for _ in range(max_cond_lvl):
-                                expand_arg = [n_iw]+list(gt_lv.shape)
-                                gt_lv = gt_lv.unsqueeze(0).expand(expand_arg)
-                        if lens is not None:
-                            expand_arg = [n_iw] + list(lens.shape)
-                            this_len = lens.unsqueeze(0).expand(expand_arg)
-                            for _ in range(max_cond_lvl):
-                                expand_arg = [n_iw] + list(this_len.shape)
-                                this_len = this_len.unsqueeze(0).expand(expand_arg)
-                            this_len = this_len.reshape(-1)
-                        else:
-                            this_len = lens
-                    else:
-                        this_len = lens
-                    self.approximator[lv].prev_state = prev_states[lv]
-                    lv(self.approximator[lv], lv_conditions, gt_samples=gt_lv, complete=(lv in self.child) or complete,
-                       lens=this_len)
-                    if lv.rep_net is None:
-                        lv.prev_state = self.approximator[lv].next_state
-                    self.approximator[lv].next_state, self.approximator[lv].prev_state = None, None
-                    if eval:
-                        if isinstance(lv, Categorical):
-                            if lv.sub_lvl_size is not None:
-                                logits_shape = lv.post_params['logits'].shape
-                                logits = lv.post_params['logits'].view(*logits_shape[:-1],
-                                                                       int(logits_shape[-1]/lv.size), lv.size)
-                                self.variables_hat[lv] = torch.nn.functional.one_hot(torch.argmax(logits, dim=-1),
-                                                                                     lv.size).float()
-                            else:
-                                self.variables_hat[lv] = torch.nn.functional.one_hot(torch.argmax(lv.post_params['logits'],
-                                                                                              dim=-1), lv.size).float()
-                                lv.post_reps = self.variables_hat[lv]
-                        elif isinstance(lv, Gaussian):
-                            self.variables_hat[lv] = lv.post_params['loc']
-                        else:
-                            raise NotImplementedError('Unidentifiable latent variable type {} for variable '
-                                                      '{}'.format(type(lv), lv.name))
+        # Ancestral sampling from the network, following the execution plan of this call's signature
+        plan_key = (frozenset(lv.name for lv in self.variables_star), target,
+                    None if force_iw is None else frozenset(force_iw), eval)
+        if plan_key not in self.plans:
+            self.plans[plan_key] = self._compile_plan(*plan_key)
+        for lv, conditions, is_iw, max_cond_lvl in self.plans[plan_key]:
+            # Gathering conditioning variables
+            lv_conditions = {}
+            for p, source, n_expand in conditions:
+                value = p.rep(self.variables_star[p], step_wise=False, prev_rep=prev_states[p]) if source == 'star' \
+                    else p.rep(self.variables_hat[p], step_wise=False, prev_rep=prev_states[p]) if source == 'hat' \
+                    else p.post_reps
+                if n_iw is not None and n_iw > 1:
+                    for _ in range(n_expand):
+                        value = value.unsqueeze(0).expand([n_iw] + list(value.shape))
+                lv_conditions[p.name] = value
+
+            # Setting up ground truth to be injected if any
+            gt_lv = self.variables_star[lv] if lv in self.variables_star else None
+
+            # Importance weighted variables are sampled n_iw times along a new first dimension, which their ground
+            # truth gets too, while their posterior parameters are computed once on the unrepeated conditions
+            this_len = lens
+            iw_samples = n_iw if is_iw else None
+            if iw_samples is not None:
+                if gt_lv is not None:
+                    for _ in range(max_cond_lvl + 1):
+                        gt_lv = gt_lv.unsqueeze(0).expand([n_iw]+list(gt_lv.shape))
+                if lens is not None:
+                    for _ in range(max_cond_lvl):
+                        this_len = this_len.unsqueeze(0).expand([n_iw] + list(this_len.shape))
+                    this_len = this_len.reshape(-1)
+            self.approximator[lv].prev_state = prev_states[lv]
+            self.approximator[lv].incremental = incremental
+            lv(self.approximator[lv], lv_conditions, gt_samples=gt_lv, complete=(lv in self.child) or complete,
+               lens=this_len, n_iw=iw_samples)
+            if lv.rep_net is None:
+                lv.prev_state = self.approximator[lv].next_state
+            self.approximator[lv].next_state, self.approximator[lv].prev_state = None, None
+            self.approximator[lv].incremental = False
+            if eval and 'hidden' not in lv.post_params:
+                if isinstance(lv, Categorical):
+                    if lv.sub_lvl_size is not None:
+                        logits_shape = lv.post_params['logits'].shape
+                        logits = lv.post_params['logits'].view(*logits_shape[:-1],
+                                                               int(logits_shape[-1]/lv.size), lv.size)
+                        self.variables_hat[lv] = torch.nn.functional.one_hot(torch.argmax(logits, dim=-1),
+                                                                             lv.size).float()
                     else:
-                        self.variables_hat[lv] = lv.post_samples
-                    self.log_proba[lv] = lv.post_gt_log_probas if gt_lv is not None else lv.post_log_probas
+                        self.variables_hat[lv] = torch.nn.functional.one_hot(torch.argmax(lv.post_params['logits'],
+                                                                                          dim=-1), lv.size).float()
+                elif isinstance(lv, Gaussian):
+                    self.variables_hat[lv] = lv.post_params['loc']
+                else:
+                    raise NotImplementedError('Unidentifiable latent variable type {} for variable '
+                                              '{}'.format(type(lv), lv.name))
+                n_event_dims = 2 if isinstance(lv, Categorical) and lv.sub_lvl_size is not None else 1
+                if iw_samples is not None and lv.post_samples is not None and \
+                        self.variables_hat[lv].ndim - n_event_dims < lv.post_samples.ndim - 1:
+                    # The estimate is shared by all the importance weighted samples
+                    self.variables_hat[lv] = self.variables_hat[lv].unsqueeze(0).expand(
+                        [n_iw] + list(self.variables_hat[lv].shape))
+                if isinstance(lv, Categorical) and lv.sub_lvl_size is None:
+                    lv.post_reps = self.variables_hat[lv]
+            else:
+                self.variables_hat[lv] = lv.post_samples
+            self.log_proba[lv] = lv.post_gt_log_probas if gt_lv is not None else lv.post_log_probas
 
         if target is None:
             assert all([lv in self.variables_hat or lv in self.variables_star for lv in self.variables])
@@ -197,25 +198,125 @@ class BayesNet(nn.Module):
         for v in self.variables: v.prev_state = None
         return new_prev_state
 
-    def _ready_condition(self, lv, n_iw, max_lvl, prev_states, dp_lvl, force_iw, eval):
-        value = lv.rep(self.variables_star[lv], step_wise=False, prev_rep=prev_states[lv])\
-                if lv in self.variables_star \
-                else lv.rep(self.variables_hat[lv], step_wise=False, prev_rep=prev_states[lv]) if eval \
-                else lv.post_reps
-        if n_iw is not None and n_iw > 1:
-            for _ in range(dp_lvl[lv] + (1 if (lv.iw or lv.name in (force_iw or [])) else 0), max_lvl):
-                expand_arg = [n_iw] + list(value.shape)
-                value = value.unsqueeze(0).expand(expand_arg)
-        return value
+    def reorder_states(self, states, index):
+        # Selects the batch rows given by index in the states returned by forward (e.g. to drop the sequences that are
+        # already finished during generation)
+        new_states = {}
+        for v, state in states.items():
+            if state is None:
+                new_states[v] = None
+            elif v.rep_net is None:
+                new_states[v] = self.approximator[v].reorder_state(state, index)
+            else:
+                # Recurrent representation states are batch-second
+                new_states[v] = tuple(s.index_select(1, index) for s in state)
+        return new_states
+
+    def static_schedule(self, input_names, output_names):
+        # Resolves, once and for all, the variables to be computed to get output_names from input_names, in an order
+        # where each variable comes after its parents
+        available = [self.name_to_v[name] for name in input_names]
+        schedule, to_visit = [], [self.name_to_v[name] for name in output_names]
+        while len(to_visit):
+            lv = to_visit[-1]
+            if lv in available or lv in schedule:
+                to_visit.pop()
+                continue
+            if lv not in self.parent:
+                raise LookupError("{} is a root of the network and must be given as an input".format(lv.name))
+            missing_parents = [p for p in self.parent[lv] if p not in available and p not in schedule]
+            if len(missing_parents):
+                to_visit.extend(missing_parents)
+            else:
+                schedule.append(to_visit.pop())
+        return schedule
+
+    def _compile_plan(self, star_names, target, force_iw, eval):
+        # Resolves the steps of the ancestral sampling for a forward signature: the variables to be computed (in the
+        # order the forward pass used to find them in), where each of their parents comes from, and how many times it
+        # is expanded for importance weighting
+        dp_lvl = self._get_dp_lvl(force_iw)
+        star = [lv for lv in self.variables if lv.name in star_names]
+        filled = [lv for lv in self.input_variables if lv.allow_prior]
+
+        if target is not None:
+            # Collecting requirements to estimate the target
+            lvs_to_fill, i = [target], 0
+            while i < len(lvs_to_fill):
+                for p in self.parent.get(lvs_to_fill[i], []):
+                    if (p not in lvs_to_fill) and (p not in star):
+                        lvs_to_fill.append(p)
+                i += 1
+        else:
+            lvs_to_fill = list(self.parent.keys())
+
+        plan = []
+        while any([lv not in filled for lv in lvs_to_fill]):
+            n_filled = len(filled)
+            for lv in lvs_to_fill:
+                parents = self.parent.get(lv, [])
+                if all([(p in star) or (p in filled) for p in parents]) and lv not in filled:
+                    max_cond_lvl = dp_lvl[lv]
+                    conditions = [(p, 'star' if p in star else 'hat' if eval else 'post',
+                                   max(0, max_cond_lvl - dp_lvl[p] - (1 if (p.iw or p.name in (force_iw or [])) else 0)))
+                                  for p in parents]
+                    is_iw = (lv.iw and force_iw is None) or bool(force_iw and lv.name in force_iw)
+                    plan.append((lv, conditions, is_iw, max_cond_lvl))
+                    filled.append(lv)
+            if len(filled) == n_filled:
+                raise LookupError("Can't reach {} from the inputs {}".format(
+                    [lv.name for lv in lvs_to_fill if lv not in filled], sorted(star_names)))
+        return plan
 
     def prior_sample(self, sample_shape):
         self.clear_values()
 
         # Getting all the latent variables that have no parents (roots), and that, consequently, need to be sampled from
         # their respective priors.
-        roots = [lv for lv in self.child.keys() if lv not in self.parent]
         inputs = {}
-        for lv in roots:
+        for lv in self.roots:
             inputs[lv.name] = lv.prior_sample(sample_shape)[0]
 
         self(inputs)
+
+
+class StaticBayesNet(nn.Module):
+    # Deterministic (i.e. eval mode) forward pass of a BayesNet, from fixed input variables to fixed output variables.
+    # The execution order is resolved at construction, and the forward pass only takes and returns tensors, so that it
+    # can be traced, scripted and exported. The outputs are the locations of Gaussian variables and the logits of
+    # Categorical variables.
+    def __init__(self, bn, input_names, output_names):
+        super(StaticBayesNet, self).__init__()
+        schedule = bn.static_schedule(input_names, output_names)
+        needed_inputs = set(p.name for lv in schedule for p in bn.parent[lv])
+        self.input_names = [name for name in input_names if name in needed_inputs or name in output_names]
+        self.output_names = list(output_names)
+        self.schedule = [lv.name for lv in schedule]
+        self.parents = {lv.name: [p.name for p in bn.parent[lv]] for lv in schedule}
+        for lv in schedule:
+            link = bn.approximator[lv]
+            if isinstance(link, SequentialLink) or link.residual is not None:
+                raise NotImplementedError("{}'s link can't be run statically".format(lv.name))
+            if not (isinstance(lv, Gaussian) or (isinstance(lv, Categorical) and lv.sub_lvl_size is None)):
+                raise NotImplementedError('Unsupported latent variable type {} for variable '
+                                          '{}'.format(type(lv), lv.name))
+        self.variables = nn.ModuleDict({name: bn.name_to_v[name] for name in self.input_names + self.schedule})
+        self.links = nn.ModuleDict({lv.name: bn.approximator[lv] for lv in schedule})
+
+    def forward(self, *inputs):
+        reps = {name: self.variables[name].rep(value, step_wise=False) for name, value in zip(self.input_names, inputs)}
+        outputs = dict(zip(self.input_names, inputs))
+        for name in self.schedule:
+            lv, link = self.variables[name], self.links[name]
+            conditions = {p: reps[p] for p in self.parents[name]}
+            if not isinstance(link, NamedLink):
+                conditions = torch.cat(list(conditions.values()), dim=-1)
+            params = link(conditions)
+            if isinstance(lv, Gaussian):
+                outputs[name] = params['loc']
+                reps[name] = lv.rep(params['loc'], step_wise=False)
+            else:
+                outputs[name] = params['logits']
+                reps[name] = lv.rep(torch.nn.functional.one_hot(torch.argmax(params['logits'], dim=-1),
+                                                                lv.size).float(), step_wise=False)
+        return tuple(outputs[name] for name in self.output_names)
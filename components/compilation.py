@@ -0,0 +1,64 @@
+# This file wraps the forward passes of the networks in torch.compile, while keeping eager execution as a fallback for
+# the parts that fail to compile
+from time import time
+
+import torch
+try:
+    from torch._dynamo.utils import counters as dynamo_counters
+except ImportError:
+    dynamo_counters = None
+
+
+def _n_compiled_graphs():
+    # Number of graphs dynamo compiled so far in this process, including the recompilations triggered by guard failures
+    # (e.g. new input shapes, or switching a module between train and eval mode)
+    return dynamo_counters['stats']['unique_graphs'] if dynamo_counters is not None else 0
+
+
+class CompiledCallable:
+    def __init__(self, fn, name, backend='inductor', dynamic=True, **compile_kwargs):
+        # dynamic=True compiles graphs that are generic in the input sizes, so that the varying batch sizes and sequence
+        # lengths don't each trigger a recompilation
+        self.fn = fn
+        self.name = name
+        # Total duration of the calls that compiled a graph, and the number of such calls
+        self.compile_time = None
+        self.n_compilations = 0
+        self.error = None
+        if hasattr(torch, 'compile'):
+            self.compiled_fn = torch.compile(fn, backend=backend, dynamic=dynamic, **compile_kwargs)
+        else:
+            self.compiled_fn = None
+            self.error = NotImplementedError("torch.compile requires torch>=2.0 (found {})".format(torch.__version__))
+
+    def __call__(self, *args, **kwargs):
+        if self.error is not None:
+            return self.fn(*args, **kwargs)
+        start, n_graphs = time(), _n_compiled_graphs()
+        try:
+            output = self.compiled_fn(*args, **kwargs)
+        except Exception as e:
+            # Errors that aren't due to compilation are raised again by the eager call
+            self.error = e
+            print("Couldn't compile {}, falling back to eager execution ({}: {})".format(self.name, type(e).__name__,
+                                                                                         e))
+            return self.fn(*args, **kwargs)
+        if self.compile_time is None:
+            self.compile_time = 0.
+        if _n_compiled_graphs() != n_graphs:
+            self.compile_time += time() - start
+            self.n_compilations += 1
+        return output
+
+
+def compilation_report(compiled_callables):
+    print("Compiled {}/{} components:".format(sum(c.error is None for c in compiled_callables),
+                                              len(compiled_callables)))
+    for c in compiled_callables:
+        if c.error is not None:
+            print("    {}: eager ({})".format(c.name, type(c.error).__name__))
+        elif c.compile_time is not None:
+            print("    {}: compiled {} time(s) in {:.2f}s".format(c.name, c.n_compilations, c.compile_time))
+        else:
+            print("    {}: not called yet".format(c.name))
+    return sum(c.compile_time for c in compiled_callables if c.error is None and c.compile_time is not None)
@@ -3,6 +3,7 @@ import abc
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
 
 from components.latent_variables import Categorical, Gaussian, MultiCategorical
 
@@ -17,6 +18,8 @@ class BaseCriterion(metaclass=abc.ABCMeta):
         self.h_params = model.h_params
         self.w = w
         self._prepared_metrics = None
+        # Set by get_loss to prepare the metrics of its step, which is only done if they are asked for (see metrics)
+        self._metrics_thunk = None
 
     @abc.abstractmethod
     def get_loss(self):
@@ -24,6 +27,9 @@ class BaseCriterion(metaclass=abc.ABCMeta):
         pass
 
     def metrics(self):
+        if self._metrics_thunk is not None:
+            thunk, self._metrics_thunk = self._metrics_thunk, None
+            thunk()
         return self._prepared_metrics
 
     @abc.abstractmethod
@@ -148,6 +154,12 @@ class ELBo(BaseCriterion):
         if self.generated_v.name in self.h_params.is_weighted:
             criterion_params.pop('weight')
         self._unweighted_criterion = nn.CrossEntropyLoss(**criterion_params)
+        self.link = self.gen_net.approximator[self.generated_v]
+        if self.h_params.vocab_chunk_size:
+            fuse_output_projection(self.link, self.generated_v)
+        # Per token log-likelihoods of the fused output projection, computed once per step for all the criteria (see
+        # _token_log_likelihood)
+        self._token_log_p = None
 
         self.log_p_xIz = None
         self.log_p_z = None
@@ -155,16 +167,31 @@ class ELBo(BaseCriterion):
 
         self.sequence_mask = None
         self.valid_n_samples = None
+        # Per dimension KLs of the latent variable pairs, and their (thresholded or not) sums, computed once per step
+        # (see _kl) and kept until the next one for the metrics
+        self._kl_per_dim = {}
+        self._kls = {}
+
+    def _kl(self, lv_n, thr=None):
+        # KL between the posteriors of the lv_n variables of the inference and generation networks for the current step
+        key = (lv_n, thr is not None)
+        if key not in self._kls:
+            if lv_n not in self._kl_per_dim:
+                self._kl_per_dim[lv_n] = kl_per_dim(self.infer_lvs[lv_n], self.gen_lvs[lv_n])
+            self._kls[key] = reduce_kl(*self._kl_per_dim[lv_n], thr=thr)
+        return self._kls[key]
+
+    def _clear_kls(self):
+        self._kl_per_dim.clear()
+        self._kls.clear()
 
     def get_loss(self, actual=False, observed=None):
-        vocab_size = self.generated_v.size
+        self._clear_kls()
+        self._token_log_p = None
         criterion = self._unweighted_criterion if actual else self.criterion
         self.sequence_mask = (self.gen_net.variables_star[self.generated_v] != self.generated_v.ignore).float()
-        temp = 1
 
-        self.log_p_xIz = - criterion(self.generated_v.post_params['logits'].view(-1, vocab_size)/temp,
-                                     self.gen_net.variables_star[self.generated_v].reshape(-1)
-                                     ).view(self.gen_net.variables_star[self.generated_v].shape) * self.sequence_mask
+        self.log_p_xIz = self._get_log_p_xIz(criterion) * self.sequence_mask
         if self.generated_v.sub_lvl_size is not None:
             self.sequence_mask = self.sequence_mask.sum(-1)
             self.log_p_xIz = self.log_p_xIz.sum(-1)
@@ -177,7 +204,7 @@ class ELBo(BaseCriterion):
             thr = None
         else:
             thr = torch.tensor([self.h_params.kl_th]).to(self.h_params.device)
-        kl = sum([kullback_liebler(self.infer_lvs[lv_n], self.gen_lvs[lv_n], thr=thr)
+        kl = sum([self._kl(lv_n, thr=thr)
                   for lv_n in self.infer_lvs.keys() if observed is None or (lv_n not in observed)])
         if observed is not None:
             self.log_p_xIz += sum([self.gen_net.log_proba[lv] for lv in self.gen_lvs.values() if lv.name in observed]) \
@@ -206,11 +233,11 @@ class ELBo(BaseCriterion):
             loss_choice, loss_threshold = self.h_params.max_elbo
             if not actual and type(kl) != int:
                 if loss_choice == 0:
-                    max_kl = torch.max(torch.stack([kullback_liebler(self.infer_lvs[lv_n], self.gen_lvs[lv_n], thr=thr)
+                    max_kl = torch.max(torch.stack([self._kl(lv_n, thr=thr)
                               for lv_n in self.infer_lvs.keys()]), dim=0)[0]
                     loss = - (torch.min(self.log_p_xIz/sen_len_rec, -coeff * max_kl/loss_threshold/sen_len_kl)).sum(1).mean(0)
                 if loss_choice == 1:
-                    kl_stack = torch.stack([kullback_liebler(self.infer_lvs[lv_n], self.gen_lvs[lv_n], thr=thr)
+                    kl_stack = torch.stack([self._kl(lv_n, thr=thr)
                               for lv_n in self.infer_lvs.keys()])
                     max_max_kl = kl_stack.max(0)[0]
                     max_kl = (kl_stack-max_max_kl.unsqueeze(0)).exp().sum(0).log()+max_max_kl*kl_stack.shape[0]
@@ -222,7 +249,7 @@ class ELBo(BaseCriterion):
                                  if (anl1 - anl0)*i+anl0 > self.model.step >= anl0 else 1
                                  for i in range(1, len(self.h_params.n_latents)+1)
                                  }
-                    this_kl = sum([kullback_liebler(self.infer_lvs[lv_n], self.gen_lvs[lv_n], thr=thr)*zi_coeffs[lv_n]
+                    this_kl = sum([self._kl(lv_n, thr=thr)*zi_coeffs[lv_n]
                                    for lv_n in self.infer_lvs.keys()
                                    if observed is None or (lv_n not in observed)])
                     this_kl *= self.sequence_mask
@@ -235,7 +262,7 @@ class ELBo(BaseCriterion):
                                  if (anl1 - anl0)*i+anl0 > self.model.step >= anl0 else 1) * max(n_lat) / n_lat[-i]
                                  for i in range(1, len(self.h_params.n_latents)+1)
                                  }
-                    this_kl = torch.max(torch.stack([kullback_liebler(self.infer_lvs[lv_n], self.gen_lvs[lv_n], thr=thr)
+                    this_kl = torch.max(torch.stack([self._kl(lv_n, thr=thr)
                                                      * zi_coeffs[lv_n]
                                                      for lv_n in self.infer_lvs.keys()]), dim=0)[0]
                     this_kl *= self.sequence_mask
@@ -249,13 +276,13 @@ class ELBo(BaseCriterion):
                                  if anl_gap*i+anl0 > self.model.step >= anl0+anl_gap*(i-1) else 1
                                  for i in range(1, len(self.h_params.n_latents)+1)
                                  }
-                    this_kl = sum([kullback_liebler(self.infer_lvs[lv_n], self.gen_lvs[lv_n], thr=thr)*zi_coeffs[lv_n]
+                    this_kl = sum([self._kl(lv_n, thr=thr)*zi_coeffs[lv_n]
                                    for lv_n in self.infer_lvs.keys()
                                    if observed is None or (lv_n not in observed)])
                     this_kl *= self.sequence_mask
                     loss = - (torch.min(self.log_p_xIz/sen_len_rec, - this_kl/loss_threshold/sen_len_kl)).sum(1).mean(0)
                 elif loss_choice == 5:
-                    max_kl = torch.max(torch.stack([kullback_liebler(self.infer_lvs[lv_n], self.gen_lvs[lv_n], thr=thr)
+                    max_kl = torch.max(torch.stack([self._kl(lv_n, thr=thr)
                               for lv_n in self.infer_lvs.keys()]), dim=0)[0]
                     loss = - (self.log_p_xIz/sen_len_rec - coeff * max_kl/sen_len_kl).sum(1).mean(0)
 
@@ -279,7 +306,7 @@ class ELBo(BaseCriterion):
                     zg_beta = zg_beta * (self.h_params.kl_beta_zg/self.h_params.kl_beta)
                     beta_i = {lv_n: (zs_beta if lv_n=='zs' else zg_beta if lv_n=='zg' else 1)
                               for lv_n in self.infer_lvs.keys()}
-                    kl = sum([kullback_liebler(self.infer_lvs[lv_n], self.gen_lvs[lv_n], thr=thr) * beta_i[lv_n]
+                    kl = sum([self._kl(lv_n, thr=thr) * beta_i[lv_n]
                               for lv_n in self.infer_lvs.keys() if observed is None or (lv_n not in observed)])
                     kl *= self.sequence_mask
                     loss = - (self.log_p_xIz / sen_len_rec - coeff * kl / sen_len_kl).sum(1).mean(0)
@@ -288,27 +315,44 @@ class ELBo(BaseCriterion):
         else:
             loss = - (self.log_p_xIz/sen_len_rec - coeff * kl/sen_len_kl).sum(1).mean(0)
 
-        with torch.no_grad():
-            if observed is None:
-                if actual and thr is None:
-                    unweighted_loss = loss
-                else:
-                    sequence_mask = (
-                                self.gen_net.variables_star[self.generated_v] != self.generated_v.ignore).float()
-                    un_log_p_xIz = \
-                        - self._unweighted_criterion(self.generated_v.post_params['logits'].view(-1, vocab_size)/temp,
-                                                     self.gen_net.variables_star[self.generated_v].reshape(-1)
-                                                     ).view(self.gen_net.variables_star[self.generated_v].shape)*sequence_mask
-                    if self.generated_v.sub_lvl_size is not None:
-                        un_log_p_xIz = un_log_p_xIz.sum(-1)
-                    kl = sum([kullback_liebler(self.infer_lvs[lv_n], self.gen_lvs[lv_n], thr=None)
-                              for lv_n in self.infer_lvs.keys()]) * self.sequence_mask
-                    unweighted_loss = - (un_log_p_xIz/sen_len_rec - kl/sen_len_kl).sum(1).mean(0)
-                self._prepare_metrics(unweighted_loss)
+        if observed is None:
+            step = self.model.step
+
+            def prepare_metrics():
+                with torch.no_grad():
+                    if actual and thr is None:
+                        unweighted_loss = loss
+                    else:
+                        if actual or self.generated_v.name not in self.h_params.is_weighted:
+                            # The reconstruction term was already computed without weights
+                            un_log_p_xIz = self.log_p_xIz
+                        else:
+                            sequence_mask = (self.gen_net.variables_star[self.generated_v] !=
+                                             self.generated_v.ignore).float()
+                            un_log_p_xIz = self._get_log_p_xIz(self._unweighted_criterion)*sequence_mask
+                            if self.generated_v.sub_lvl_size is not None:
+                                un_log_p_xIz = un_log_p_xIz.sum(-1)
+                        kl = sum([self._kl(lv_n)
+                                  for lv_n in self.infer_lvs.keys()]) * self.sequence_mask
+                        unweighted_loss = - (un_log_p_xIz/sen_len_rec - kl/sen_len_kl).sum(1).mean(0)
+                    self._prepare_metrics(unweighted_loss, step)
+            self._metrics_thunk = prepare_metrics
+        else:
+            self._metrics_thunk = None
 
         return loss
 
-    def _prepare_metrics(self, loss):
+    def _get_log_p_xIz(self, criterion):
+        # Log-likelihood of each ground truth token (0 for padding)
+        gt = self.gen_net.variables_star[self.generated_v]
+        if 'hidden' in self.generated_v.post_params:
+            gt, coeffs = _criterion_coeffs(criterion, gt)
+            return _token_log_likelihood(self, gt) * coeffs
+        return - criterion(self.generated_v.post_params['logits'].view(-1, self.generated_v.size),
+                           gt.reshape(-1)).view(gt.shape)
+
+    def _prepare_metrics(self, loss, step=None):
+        step = self.model.step if step is None else step
         current_elbo = - loss
         LL_name = '/p({}I{})'.format(self.generated_v.name, ', '.join(sorted(p.name for p in
                                                                              self.gen_net.parent[self.generated_v])))
@@ -322,7 +366,7 @@ class ELBo(BaseCriterion):
             gen_v_name = gen_lv.name + ('I{}'.format(', '.join([lv.name for lv in self.gen_net.parent[gen_lv]]))
                                         if gen_lv in self.gen_net.parent else '')
             KL_name = '/KL(q({})IIp({}))'.format(infer_v_name, gen_v_name)
-            kl_i = kullback_liebler(inf_lv, gen_lv)*self.sequence_mask
+            kl_i = self._kl(lv)*self.sequence_mask
             KL_value = torch.sum(kl_i)/self.valid_n_samples
             self.KL_dict[KL_name] = KL_value
         if not (type(self.h_params.n_latents) == int and self.h_params.n_latents == 1):
@@ -345,12 +389,57 @@ class ELBo(BaseCriterion):
                     #     self.KL_dict[KL_var_name] = torch.std(torch.tensor(KLs))
 
         if self.h_params.anneal_kl_type == 'linear' and \
-                self.h_params.anneal_kl and self.model.step <= self.h_params.anneal_kl[0]:
+                self.h_params.anneal_kl and step <= self.h_params.anneal_kl[0]:
             self._prepared_metrics = {LL_name: LL_value}
         else:
             self._prepared_metrics = {'/ELBo': current_elbo, LL_name: LL_value, **self.KL_dict}
 
 
+class SampledSoftmaxELBo(ELBo):
+    # ELBo whose reconstruction term is estimated, during training, with a sampled softmax (Jean et al., 2015): each
+    # token is only scored against h_params.sampled_softmax negative tokens drawn from the (smoothed) unigram
+    # distribution of the vocabulary, instead of the whole vocabulary. The generation link then outputs its hidden
+    # states instead of the vocabulary logits. In evaluation, the full softmax is used.
+    def __init__(self, model, w):
+        super(SampledSoftmaxELBo, self).__init__(model, w)
+        assert self.generated_v.name not in self.h_params.is_weighted, "Sampled softmax can't be weighted"
+        assert self.generated_v.sub_lvl_size is None, "Sampled softmax is not implemented for sub-level variables"
+        assert not self.h_params.vocab_chunk_size, "Sampled softmax can't be used with the fused output projection"
+        self.n_samples = self.h_params.sampled_softmax
+        assert self.link.embedding is not None and getattr(self.link, 'sbn', None) is None, \
+            "Sampled softmax requires a generation link with a tied embedding output projection"
+        self.link.hidden_output = True
+        vocab_index = model.index[self.generated_v]
+        counts = torch.tensor([vocab_index.freqs[w] for w in vocab_index.itos], dtype=torch.float) + 1
+        self.log_unigram = (counts/counts.sum()).log().to(self.h_params.device)
+
+    def _get_log_p_xIz(self, criterion):
+        if 'hidden' not in self.generated_v.post_params:
+            return super(SampledSoftmaxELBo, self)._get_log_p_xIz(criterion)
+        hidden, gt = self.generated_v.post_params['hidden'], self.gen_net.variables_star[self.generated_v]
+        weight = self.link.embedding.weight
+        # The same negative samples are used for the whole batch. Logits are corrected by the log of their sampling
+        # probability, and sampled tokens that are the ground truth are ignored.
+        sampled = torch.multinomial(self.log_unigram.exp(), self.n_samples, replacement=True)
+        gt_logits = (hidden * weight[gt]).sum(-1) - self.log_unigram[gt]
+        sampled_logits = torch.matmul(hidden, weight[sampled].transpose(0, 1)) - self.log_unigram[sampled]
+        sampled_logits = sampled_logits.masked_fill(sampled == gt.unsqueeze(-1), float('-inf'))
+        return torch.cat([gt_logits.unsqueeze(-1), sampled_logits], dim=-1).log_softmax(-1)[..., 0]
+
+    def get_loss(self, actual=False, observed=None):
+        loss = super(SampledSoftmaxELBo, self).get_loss(actual=actual, observed=observed)
+        if 'hidden' in self.generated_v.post_params and self._metrics_thunk is not None and \
+                (self.model.step + 1) % self.h_params.log_every == 0:
+            # The metrics of the logged training steps report the full softmax likelihood instead of its sampled
+            # estimate. It is computed here since the optimizer step updates the embedding before they are prepared.
+            with torch.no_grad():
+                gt = self.gen_net.variables_star[self.generated_v]
+                gt, coeffs = _criterion_coeffs(self._unweighted_criterion, gt)
+                log_p = self.link.project_on_embedding(self.generated_v.post_params['hidden']).log_softmax(-1)
+                self.log_p_xIz = log_p.gather(-1, gt.unsqueeze(-1)).squeeze(-1) * coeffs * self.sequence_mask
+        return loss
+
+
 class Reconstruction(BaseCriterion):
     def __init__(self, model, w):
         super(Reconstruction, self).__init__(model, w)
@@ -369,6 +458,12 @@ class Reconstruction(BaseCriterion):
         if self.generated_v.name in self.h_params.is_weighted:
             criterion_params.pop('weight')
         self._unweighted_criterion = nn.CrossEntropyLoss(**criterion_params)
+        self.link = self.gen_net.approximator[self.generated_v]
+        if self.h_params.vocab_chunk_size:
+            fuse_output_projection(self.link, self.generated_v)
+        # Per token log-likelihoods of the fused output projection, computed once per step for all the criteria (see
+        # _token_log_likelihood)
+        self._token_log_p = None
 
         self.log_p_x = None
 
@@ -376,25 +471,29 @@ class Reconstruction(BaseCriterion):
         self.valid_n_samples = None
 
     def get_loss(self, actual=False):
-
-        vocab_size = self.generated_v.size
+        self._token_log_p = None
         criterion = self._unweighted_criterion if actual else self.criterion
-        temp = 1
-        self.log_p_x = - criterion(self.generated_v.post_params['logits'].view(-1, vocab_size)/temp,
-                                     self.gen_net.variables_star[self.generated_v].reshape(-1))
+        self.log_p_x = self._get_log_p_x(criterion)
         loss = - self.log_p_x
 
         with torch.no_grad():
             if actual:
                 self._prepare_metrics(loss)
             else:
-                un_log_p_x = - self._unweighted_criterion(self.generated_v.post_params['logits'].view(-1, vocab_size)/temp,
-                                                          self.gen_net.variables_star[self.generated_v].reshape(-1)
-                                                          )
+                un_log_p_x = self._get_log_p_x(self._unweighted_criterion)
                 self._prepare_metrics(un_log_p_x)
 
         return loss
 
+    def _get_log_p_x(self, criterion):
+        # Mean log-likelihood of the ground truth tokens
+        gt = self.gen_net.variables_star[self.generated_v].reshape(-1)
+        if 'hidden' in self.generated_v.post_params:
+            gt, coeffs = _criterion_coeffs(criterion, gt)
+            return (_token_log_likelihood(self, gt) * coeffs).sum() / coeffs.sum()
+        temp = 1
+        return - criterion(self.generated_v.post_params['logits'].view(-1, self.generated_v.size)/temp, gt)
+
     def _prepare_metrics(self, loss):
         current_ll = - loss
         LL_name = '/p({})'.format(self.generated_v.name)
@@ -410,8 +509,8 @@ class IWLBo(ELBo):
         self.input_dimensions = self.h_params.input_dimensions
 
     def get_loss(self, actual=False, observed=None):
-
-        vocab_size = self.generated_v.size
+        self._clear_kls()
+        self._token_log_p = None
         criterion = self._unweighted_criterion if actual else self.criterion
         self.sequence_mask = (self.gen_net.variables_star[self.generated_v] != self.generated_v.ignore).float()
         if self.generated_v.sub_lvl_size is not None:
@@ -419,26 +518,24 @@ class IWLBo(ELBo):
         self.valid_n_samples = torch.sum(self.sequence_mask)
         sen_len_kl = self.sequence_mask.sum(-1).unsqueeze(-1)
         sen_len_rec = 1 if any([lv.sequence_lv for lv in self.gen_lvs.values()]) else sen_len_kl
-        loss_shape = self.generated_v.post_params['logits'].shape[:-1]
+        # The outputs are the vocabulary logits, or the hidden states to be projected on them with the fused output
+        # projection
+        outputs = self.generated_v.post_params.get('hidden', self.generated_v.post_params.get('logits'))
+        loss_shape = outputs.shape[:-1]
         if len(loss_shape) > 2:
-            logits, gt = self.generated_v.post_params['logits'], self.gen_net.variables_star[self.generated_v]
+            gt = self.gen_net.variables_star[self.generated_v]
             if self.generated_v.sub_lvl_size is not None:
                 batchxseq_size = gt.shape[-3]*gt.shape[-2]*gt.shape[-1]
             else:
                 batchxseq_size = gt.shape[-2]*gt.shape[-1]
-            logits, gt = logits.reshape(-1, batchxseq_size, vocab_size), torch.unbind(gt.reshape(-1, batchxseq_size))[0]
-            log_p_xIz = []
-            for logits_i in torch.unbind(logits):
-                log_p_xIz.append(- criterion(logits_i, gt))
+            outputs, gt = outputs.reshape(-1, batchxseq_size, outputs.shape[-1]), gt.reshape(-1, batchxseq_size)[0]
+            log_p_xIz = self._iw_log_likelihood(criterion, outputs, gt)
             if self.generated_v.sub_lvl_size:
-                log_p_xIz = torch.cat(log_p_xIz, dim=0).view((*loss_shape, self.generated_v.sub_lvl_size)).sum(-1)
+                log_p_xIz = log_p_xIz.view((*loss_shape, self.generated_v.sub_lvl_size)).sum(-1)
             else:
-                log_p_xIz = torch.cat(log_p_xIz, dim=0).view(loss_shape)
+                log_p_xIz = log_p_xIz.view(loss_shape)
         else:
-            loss_shape = self.generated_v.post_params['logits'].shape[:-1]
-            log_p_xIz = - criterion(self.generated_v.post_params['logits'].view(-1, vocab_size),
-                                    self.gen_net.variables_star[self.generated_v].reshape(-1)
-                                    )
+            log_p_xIz = self._get_log_p_xIz(criterion)
             if self.generated_v.sub_lvl_size:
                 sub_seq_mask = (self.gen_net.variables_star[self.generated_v] != self.generated_v.ignore).float()
                 log_p_xIz = (log_p_xIz.view((*loss_shape, self.generated_v.sub_lvl_size))*sub_seq_mask).sum(-1)
@@ -506,30 +603,51 @@ class IWLBo(ELBo):
             DReG_weights = (detached_exp_log_wi / (1e-8 + torch.sum(detached_exp_log_wi, dim=0).unsqueeze(0)))**2
             loss = - torch.mean(DReG_weights * log_wi).type(torch.float32)
 
-        with torch.no_grad():
-            if observed is None:
-                if actual:
-                    unweighted_loss = loss
-                else:
-                    log_wi = ((log_p_z - log_q_zIx)/sen_len_kl + log_p_xIz/sen_len_rec).sum(-1)
-                    # print("logp_z", log_p_z-log_q_zIx)
-                    # print("logq_zIx", )
-                    # print("logp_x|z", log_p_xIz)
-
-                    max_log_wi = torch.max(log_wi)
-                    exp_log_wi = torch.exp(log_wi - max_log_wi)
-                    while exp_log_wi.ndim > self.input_dimensions-1:
-                        exp_log_wi = torch.mean(exp_log_wi, dim=0)
-                    summed_log_wi = torch.log(exp_log_wi) + max_log_wi
-                    # print((torch.log(exp_log_wi+1e-8) + max_log_wi).sum()/self.valid_n_samples,
-                    #       (torch.log(exp_log_wi) + max_log_wi).sum()/self.valid_n_samples)
-                    unweighted_loss = - torch.mean(summed_log_wi)
-                self.ll_value = ((log_p_xIz/sen_len_rec).sum(-1)).mean()
-                self._prepare_metrics(unweighted_loss)
+        if observed is None:
+            step = self.model.step
+
+            def prepare_metrics():
+                with torch.no_grad():
+                    if actual:
+                        unweighted_loss = loss
+                    else:
+                        log_wi = ((log_p_z - log_q_zIx)/sen_len_kl + log_p_xIz/sen_len_rec).sum(-1)
+                        # print("logp_z", log_p_z-log_q_zIx)
+                        # print("logq_zIx", )
+                        # print("logp_x|z", log_p_xIz)
+
+                        max_log_wi = torch.max(log_wi)
+                        exp_log_wi = torch.exp(log_wi - max_log_wi)
+                        while exp_log_wi.ndim > self.input_dimensions-1:
+                            exp_log_wi = torch.mean(exp_log_wi, dim=0)
+                        summed_log_wi = torch.log(exp_log_wi) + max_log_wi
+                        # print((torch.log(exp_log_wi+1e-8) + max_log_wi).sum()/self.valid_n_samples,
+                        #       (torch.log(exp_log_wi) + max_log_wi).sum()/self.valid_n_samples)
+                        unweighted_loss = - torch.mean(summed_log_wi)
+                    self.ll_value = ((log_p_xIz/sen_len_rec).sum(-1)).mean()
+                    self._prepare_metrics(unweighted_loss, step)
+            self._metrics_thunk = prepare_metrics
+        else:
+            self._metrics_thunk = None
 
         return loss
 
-    def _prepare_metrics(self, loss):
+    def _iw_log_likelihood(self, criterion, outputs, gt):
+        # Equivalent of - criterion(logits_i, gt) for each importance sample logits_i in the logits [n_iw, N, V], computed
+        # for all of them at once (or for h_params.iw_chunk_size of them at a time), with gt [N] broadcast over the
+        # samples. With the fused output projection, outputs are the hidden states [n_iw, N, D] instead of the logits.
+        gt, coeffs = _criterion_coeffs(criterion, gt)
+        if 'hidden' in self.generated_v.post_params:
+            return embedding_log_likelihood(outputs, self.link.embedding.weight, gt.expand(*outputs.shape[:-1]),
+                                            self.h_params.vocab_chunk_size) * coeffs
+        log_p_xIz = []
+        for logits_i in torch.split(outputs, self.h_params.iw_chunk_size or outputs.shape[0]):
+            gt_i = gt.expand(logits_i.shape[0], gt.shape[0]).unsqueeze(-1)
+            log_p_xIz.append(logits_i.gather(-1, gt_i).squeeze(-1) - torch.logsumexp(logits_i, dim=-1))
+        return torch.cat(log_p_xIz, dim=0) * coeffs
+
+    def _prepare_metrics(self, loss, step=None):
+        step = self.model.step if step is None else step
         current_iwlbo = - loss
         LL_name = '/p({}I{})'.format(self.generated_v.name, ', '.join([lv for lv in self.infer_lvs]))
         LL_value = self.ll_value
@@ -537,7 +655,7 @@ class IWLBo(ELBo):
         kl_sum = 0
 
         sen_len_kl = self.sequence_mask.sum(-1).unsqueeze(-1)
-        if self.model.step <= self.h_params.anneal_kl[0] and self.h_params.anneal_kl_type == 'linear':
+        if step <= self.h_params.anneal_kl[0] and self.h_params.anneal_kl_type == 'linear':
             self._prepared_metrics = {LL_name: LL_value}
         else:
             for lv in self.gen_lvs.keys():
@@ -548,7 +666,7 @@ class IWLBo(ELBo):
                 gen_v_name = gen_lv.name + ('I{}'.format(', '.join([lv.name for lv in self.gen_net.parent[gen_lv]]))
                                             if gen_lv in self.gen_net.parent else '')
                 KL_name = '/KL(q({})IIp({}))'.format(infer_v_name, gen_v_name)
-                kl_i = kullback_liebler(inf_lv, gen_lv)*self.sequence_mask
+                kl_i = self._kl(lv)*self.sequence_mask
                 KL_value = (kl_i/sen_len_kl).sum(-1).mean()
                 kl_sum += KL_value
                 KL_dict[KL_name] = KL_value
@@ -556,12 +674,25 @@ class IWLBo(ELBo):
 
 
 def kullback_liebler(lv0, lv1, thr=None, slice=None):
-    # Accounting for the case when it's not estimated do to pure reconstruction phase
+    return reduce_kl(*kl_per_dim(lv0, lv1), thr=thr, slice=slice)
+
+
+def kl_per_dim(lv0, lv1):
+    # Per dimension KL between the posteriors of lv0 and lv1, along with the sequence length along which its sum must be
+    # broadcast (None unless both variables are sentence level). It is None when it's not estimated due to pure
+    # reconstruction phase.
     params0, params1 = lv0.post_params, lv1.post_params
     assert lv0.sub_lvl_size is None and lv1.sub_lvl_size is None \
         , "Kullback leibler for sublvl variables is still not implemented"
     if params1 is None:
-        return 0
+        return None, None
+    seq_len = None
+    if lv0.sequence_lv and lv1.sequence_lv:
+        # Sentence level variables have the same parameters at every position, so their KL is computed once per
+        # sentence and broadcast along the sequence
+        seq_len = max(params0[k].shape[-2] for k in lv0.parameter_activations)
+        params0 = {k: v[..., :1, :] if k in lv0.parameter_activations else v for k, v in params0.items()}
+        params1 = {k: v[..., :1, :] if k in lv1.parameter_activations else v for k, v in params1.items()}
     if isinstance(lv0, Gaussian) and isinstance(lv1, Gaussian):
         # The gaussian case
         sig0, sig1 = params0['scale']**2, params1['scale']**2
@@ -569,20 +700,11 @@ def kullback_liebler(lv0, lv1, thr=None, slice=None):
         mu0, mu1 = params0['loc'], params1['loc']
 
         kl_per_dim = 0.5*(sig0/sig1+(mu1-mu0)**2/sig1 + torch.log(sig1) - torch.log(sig0) - 1)
-        if slice is not None:
-            kl_per_dim = kl_per_dim[..., slice[0]:slice[1]]
-        if thr is not None:
-            kl_per_dim = torch.max(kl_per_dim, thr)
-        return torch.sum(kl_per_dim, dim=-1)
     elif isinstance(lv0, Categorical) and isinstance(lv1, Categorical):
-        assert slice is None
         # The categorical case
         logit0, logit1 = params0['logits'], params1['logits']
         kl_per_dim = torch.softmax(logit0, dim=-1)*(torch.log_softmax(logit0, dim=-1) -
                                                     torch.log_softmax(logit1, dim=-1))
-        if thr is not None:
-            kl_per_dim = torch.max(kl_per_dim, thr)
-        return torch.sum(kl_per_dim, dim=-1)
     elif isinstance(lv0, MultiCategorical) and isinstance(lv1, MultiCategorical):
         # The multicategorical case
         logit0, logit1 = params0['logits'], params1['logits']
@@ -591,11 +713,93 @@ def kullback_liebler(lv0, lv1, thr=None, slice=None):
         kl_per_dim = torch.softmax(logit0, dim=-1)*(torch.log_softmax(logit0, dim=-1) -
                                                     torch.log_softmax(logit1, dim=-1))
         kl_per_dim = kl_per_dim.reshape(kl_per_dim.shape[:-2]+(kl_per_dim.shape[-2]*kl_per_dim.shape[-1],))
-        if slice is not None:
-            kl_per_dim = kl_per_dim[..., slice[0]:slice[1]]
-        if thr is not None:
-            kl_per_dim = torch.max(kl_per_dim, thr)
-        return torch.sum(kl_per_dim, dim=-1)
     else:
         raise NotImplementedError('The cas where lv0 is {} and lv1 is {} '
                                   'is not implemented yet'.format(repr(type(lv0)), repr(type(lv0))))
+    return kl_per_dim, seq_len
+
+
+def reduce_kl(kl_per_dim, seq_len=None, thr=None, slice=None):
+    # Sums the per dimension KL returned by kl_per_dim, after slicing it and applying the free bits threshold thr
+    if kl_per_dim is None:
+        return 0
+    if slice is not None:
+        kl_per_dim = kl_per_dim[..., slice[0]:slice[1]]
+    if thr is not None:
+        kl_per_dim = torch.max(kl_per_dim, thr)
+    kl = torch.sum(kl_per_dim, dim=-1)
+    if seq_len is not None:
+        kl = kl.expand(*kl.shape[:-1], seq_len)
+    return kl
+
+
+# ============================================== FUSED OUTPUT PROJECTION ===============================================
+
+def fuse_output_projection(link, generated_v):
+    # Makes the link output its hidden states instead of the logits of generated_v in training (and in evaluation when
+    # its eval_hidden_output is set), which the criteria then score with embedding_log_likelihood
+    assert link.embedding is not None and getattr(link, 'sbn', None) is None, \
+        "The fused output projection requires a generation link with a tied embedding output projection"
+    assert generated_v.sub_lvl_size is None, "The fused output projection is not implemented for sub-level variables"
+    link.hidden_output = True
+
+
+def embedding_log_likelihood(hidden, weight, gt, chunk_size):
+    # Log-softmax of the projection of the hidden states [..., D] on the embedding matrix weight [V, D], taken at the
+    # ground truth indices gt [...]. The logits are only computed chunk_size vocabulary entries at a time, with a running
+    # logsumexp, and are computed again in the backward pass instead of being kept.
+    log_p = _EmbeddingLogLikelihood.apply(hidden.reshape(-1, hidden.shape[-1]), weight, gt.reshape(-1), chunk_size)
+    return log_p.view(gt.shape)
+
+
+class _EmbeddingLogLikelihood(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, hidden, weight, gt, chunk_size):
+        lse = None
+        for start in range(0, weight.shape[0], chunk_size):
+            chunk_lse = torch.logsumexp(torch.matmul(hidden, weight[start:start+chunk_size].t()), dim=-1)
+            lse = chunk_lse if lse is None else torch.logaddexp(lse, chunk_lse)
+        ctx.save_for_backward(hidden, weight, gt, lse)
+        ctx.chunk_size = chunk_size
+        return (hidden * weight[gt]).sum(-1) - lse
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        # The gradient of the log-likelihood wrt the logits is one_hot(gt) - softmax(logits)
+        hidden, weight, gt, lse = ctx.saved_tensors
+        grad_hidden, grad_weight = None, None
+        grad_output = grad_output.unsqueeze(-1)
+        if ctx.needs_input_grad[0]:
+            grad_hidden = grad_output * weight[gt]
+        if ctx.needs_input_grad[1]:
+            grad_weight = torch.zeros_like(weight).index_add_(0, gt, grad_output * hidden)
+        for start in range(0, weight.shape[0], ctx.chunk_size):
+            chunk = weight[start:start+ctx.chunk_size]
+            grad_logits = torch.exp(torch.matmul(hidden, chunk.t()) - lse.unsqueeze(-1)) * grad_output
+            if grad_hidden is not None:
+                grad_hidden -= torch.matmul(grad_logits, chunk)
+            if grad_weight is not None:
+                grad_weight[start:start+ctx.chunk_size] -= torch.matmul(grad_logits.t(), hidden)
+        return grad_hidden, grad_weight, None, None
+
+
+def _token_log_likelihood(loss, gt):
+    # Log-likelihood of each token of gt under the hidden states of the generated variable of the criterion loss. It is
+    # computed once per step and kept in loss._token_log_p, so that weighted and unweighted scores (the latter possibly
+    # prepared after the optimizer updated the embedding) share the same forward pass values.
+    if loss._token_log_p is None:
+        loss._token_log_p = embedding_log_likelihood(loss.generated_v.post_params['hidden'], loss.link.embedding.weight,
+                                                     gt, loss.h_params.vocab_chunk_size)
+    return loss._token_log_p
+
+
+def _criterion_coeffs(criterion, gt):
+    # Factors a CrossEntropyLoss criterion applies to the log-likelihood of each token in gt (0 for the ignored ones,
+    # the class weights otherwise), along with gt where the ignored indices are replaced with a valid one
+    ignored = gt == criterion.ignore_index
+    coeffs = (~ignored).float()
+    gt = gt.masked_fill(ignored, 0)
+    if criterion.weight is not None:
+        coeffs = coeffs * criterion.weight[gt]
+    return gt, coeffs
@@ -1,4 +1,5 @@
 import abc
+import math
 
 import torch
 import torch.nn as nn
@@ -79,9 +80,9 @@ class BaseLatentVariable(nn.Module, metaclass=abc.ABCMeta):
         # TODO: handle SMC case
         pass
 
-    def posterior_sample(self, x_params):
+    def posterior_sample(self, x_params, sample_shape=torch.Size()):
         # Returns a sample from P(z|x). x is a dictionary containing the distribution's parameters.
-        sample = self.posterior(**x_params).rsample()
+        sample = self.posterior(**x_params).rsample(sample_shape)
         # Applying STL
         if self.stl:
             prior = self.posterior(**{k: v.detach() for k, v in x_params.items()})
@@ -160,13 +161,17 @@ class BaseLatentVariable(nn.Module, metaclass=abc.ABCMeta):
             distrib = self.prior(**self.post_params)
             return distrib.log_prob(sample)
 
-    def forward(self, link_approximator, inputs, prior=None, gt_samples=None, complete=True, lens=None):
+    def forward(self, link_approximator, inputs, prior=None, gt_samples=None, complete=True, lens=None, n_iw=None):
+        # With n_iw, n_iw importance weighted samples are drawn along a new first dimension. Non sequential posteriors
+        # are computed once on the inputs and sampled n_iw times, while sequential ones need their inputs repeated.
         if isinstance(link_approximator, SequentialLink) or (link_approximator.residual is not None and
                                                              isinstance(link_approximator.residual['link'],
                                                                         SequentialLink)):
+            if n_iw is not None:
+                inputs = {k: v.unsqueeze(0).expand([n_iw]+list(v.shape)) for k, v in inputs.items()}
             self._sequential_forward(link_approximator, inputs, prior, gt_samples)
         else:
-            self._forward(link_approximator, inputs, prior, gt_samples, complete=complete, lens=lens)
+            self._forward(link_approximator, inputs, prior, gt_samples, complete=complete, lens=lens, n_iw=n_iw)
 
     @abc.abstractmethod
     def rep(self, samples, step_wise=True, prev_rep=None):
@@ -256,7 +261,7 @@ class BaseLatentVariable(nn.Module, metaclass=abc.ABCMeta):
         else:
             self.post_gt_log_probas = None
 
-    def _forward(self, link_approximator, inputs, prior=None, gt_samples=None, complete=True, lens=None):
+    def _forward(self, link_approximator, inputs, prior=None, gt_samples=None, complete=True, lens=None, n_iw=None):
         if link_approximator.residual is None:
             if not isinstance(link_approximator, NamedLink):
                 inputs = torch.cat(list(inputs.values()), dim=-1)
@@ -268,14 +273,26 @@ class BaseLatentVariable(nn.Module, metaclass=abc.ABCMeta):
                       torch.cat([v for k, v in inputs.items() if k not in link_approximator.residual['conditions']],
                                 dim=-1))
         self.post_params = link_approximator(inputs, lens=lens)
-        if complete:
-            self.post_samples, self.post_log_probas = self.posterior_sample(self.post_params)
+        # Links that output hidden states instead of logits leave the scoring of the samples to the criterion
+        if complete and 'hidden' not in self.post_params:
+            sample_shape = () if n_iw is None else (n_iw,)
             if self.sequence_lv:
-                self.post_samples = self.post_samples[..., :1, :].expand(self.post_samples.shape)
-                self.post_log_probas = self.post_log_probas[..., :1].expand(self.post_log_probas.shape)
+                # Sentence level variables have the same parameters at every position, so they are sampled once per
+                # sentence and their samples are broadcast along the sequence
+                seq_len = self.post_params[next(iter(self.parameter_activations))].shape[-2]
+                samples, log_probas = self.posterior_sample({k: v[..., :1, :] if k in self.parameter_activations else v
+                                                             for k, v in self.post_params.items()}, sample_shape)
+                self.post_samples = samples.expand(*samples.shape[:-2], seq_len, samples.shape[-1])
+                self.post_log_probas = log_probas.expand(*log_probas.shape[:-1], seq_len)
+            else:
+                self.post_samples, self.post_log_probas = self.posterior_sample(self.post_params, sample_shape)
             self.post_reps = self.rep(self.post_samples, step_wise=False)
             if gt_samples is not None:
-                if isinstance(self, Gaussian):
+                if isinstance(self, Gaussian) and self.sequence_lv:
+                    gt_log_probas = self.prior(**{k: v[..., :1, :] for k, v in self.post_params.items()}
+                                               ).log_prob(gt_samples[..., :1, :])
+                    self.post_gt_log_probas = gt_log_probas.expand(*gt_log_probas.shape[:-1], seq_len)
+                elif isinstance(self, Gaussian):
                     self.post_gt_log_probas = self.prior(**self.post_params).log_prob(gt_samples)
                 elif isinstance(self, Categorical):
                     self.post_params = {**self.post_params, **{'temperature': self.prior_temperature}}
@@ -321,8 +338,8 @@ class Gaussian(BaseLatentVariable):
     def infer(self, x_params):
         return x_params['loc']
 
-    def posterior_sample(self, x_params):
-        return super(Gaussian, self).posterior_sample(x_params)
+    def posterior_sample(self, x_params, sample_shape=torch.Size()):
+        return super(Gaussian, self).posterior_sample(x_params, sample_shape)
 
     def rep(self, samples, step_wise=True, prev_rep=None):
         if self.rep_net is None:
@@ -351,17 +368,23 @@ class Gaussian(BaseLatentVariable):
                 reps = reps.view(*orig_shape[:-1], reps.shape[-1])
         return reps
 
-    def get_mi(self, prior_lv):
+    def get_mi(self, prior_lv, block_size=256):
         # MI upperbound as instructed in "LAGGING INFERENCE NETWORKS AND POSTERIOR
         # COLLAPSE IN VARIATIONAL AUTOENCODERS", He et al. (2019) section 4.2 (originally from Dieng et.al (2018)
-        params0, params1 = self.post_params, prior_lv.post_params
+        # The aggregate posterior is that of the batch (see aggregate_posterior_log_prob).
+        params0, params1, samples = self.post_params, prior_lv.post_params, self.post_samples
+        if self.sequence_lv and prior_lv.sequence_lv:
+            # Sentence level variables have the same parameters and samples at every position
+            params0 = {k: v[..., :1, :] for k, v in params0.items()}
+            params1 = {k: v[..., :1, :] for k, v in params1.items()}
+            samples = samples[..., :1, :]
         sig0, sig1 = params0['scale'] ** 2, params1['scale'] ** 2
 
         mu0, mu1 = params0['loc'], params1['loc']
 
         mean_kl = (0.5 * (sig0 / sig1 + (mu1 - mu0) ** 2 / sig1 + torch.log(sig1) - torch.log(sig0) - 1)).sum(-1).mean()
-        log_qz = self.post_log_prob(self.post_samples.unsqueeze(1).expand(-1, self.post_samples.shape[0], -1, -1)).mean(0)
-        log_pz = prior_lv.post_log_prob(self.post_samples)
+        log_qz = aggregate_posterior_log_prob(samples, params0['loc'], params0['scale'], block_size)
+        log_pz = diag_normal(params1['loc'], params1['scale']).log_prob(samples)
         marginal_kl = (log_qz - log_pz).mean()
 
         return mean_kl - marginal_kl
@@ -384,6 +407,9 @@ class Categorical(BaseLatentVariable):
                                           is_placeholder, inv_seq, stl, repnet, iw, sequence_lv,
                                           sub_lvl_size=sub_lvl_size)
         self.embedding = embedding
+        # Embeddings of token tensors computed beforehand for the current step, as {id(tokens): (tokens, embeddings)}
+        # (see DisentanglementTransformerVAE._embed_text)
+        self.embedding_cache = None
         self.w_drp = nn.Dropout(word_dropout) if word_dropout is not None else None
         embedding_size = embedding.weight.shape[1]
         if self.rep_net is not None and not markovian:
@@ -394,7 +420,7 @@ class Categorical(BaseLatentVariable):
         inferred = torch.argmax(x_params['logits'], dim=-1)
         return inferred
 
-    def posterior_sample(self, x_params):
+    def posterior_sample(self, x_params, sample_shape=torch.Size()):
         if 'temperature' not in x_params:
             x_params = {**x_params, **{'temperature': self.prior_temperature}}
         #return torch.log(torch.softmax(x_params['logits'], dim=-1)), super(Categorical, self).posterior_sample(x_params)[1]
@@ -402,10 +428,10 @@ class Categorical(BaseLatentVariable):
             logit_shape = x_params['logits'].shape
             x_params['logits'] = x_params['logits'].view(*logit_shape[:-1], self.sub_lvl_size,
                                                          int(logit_shape[-1]/self.sub_lvl_size))
-            sample, log_prob = super(Categorical, self).posterior_sample(x_params)
+            sample, log_prob = super(Categorical, self).posterior_sample(x_params, sample_shape)
             return sample.view((*sample.shape[:-2], sample.shape[-2]*sample.shape[-1])), log_prob.sum(-1)
         else:
-            return super(Categorical, self).posterior_sample(x_params)
+            return super(Categorical, self).posterior_sample(x_params, sample_shape)
 
     def rep(self, samples, step_wise=True, prev_rep=None):
         if self.sub_lvl_size is not None and samples.dtype != torch.long:
@@ -414,7 +440,8 @@ class Categorical(BaseLatentVariable):
         if samples.shape[-1] == self.size and samples.dtype != torch.long:
             embedded = torch.matmul(samples, self.embedding.weight)
         else:
-            embedded = self.embedding(samples)
+            cached = self.embedding_cache.get(id(samples)) if self.embedding_cache is not None else None
+            embedded = cached[1] if cached is not None and cached[0] is samples else self.embedding(samples)
         if self.batch_norm is not None:
             embd_shape = embedded.shape
             embedded = self.batch_norm(embedded.view((-1, embedded.shape[-1]))).view(embd_shape)
@@ -492,10 +519,10 @@ class MultiCategorical(BaseLatentVariable):
         inferred = torch.argmax(x_params['logits'], dim=-1)
         return inferred
 
-    def posterior_sample(self, x_params):
+    def posterior_sample(self, x_params, sample_shape=torch.Size()):
         if 'temperature' not in x_params:
             x_params = {**x_params, **{'temperature': self.prior_temperature}, 'n_disc':self.n_disc}
-        return super(MultiCategorical, self).posterior_sample(x_params)
+        return super(MultiCategorical, self).posterior_sample(x_params, sample_shape)
 
     def rep(self, samples, step_wise=True, prev_rep=None):
         embedded = self.embedding(samples)
@@ -542,6 +569,25 @@ def diag_normal(loc, scale):
     return Independent(Normal(loc, scale), 1)
 
 
+def aggregate_posterior_log_prob(samples, loc, scale, block_size=256):
+    # Log density of each sample [N, ..., D] under the aggregate posterior of the N diagonal gaussians loc, scale
+    # [N, ..., D] (the mixture, with equal weights, of all of them), i.e. logsumexp_j log q(z_i|x_j) - log N. The N x N
+    # pairwise log densities are computed in blocks of block_size x block_size, and their logsumexp is accumulated over
+    # the blocks of gaussians.
+    log_scale = scale.log()
+    log_probs = []
+    for samples_i in torch.split(samples, block_size):
+        log_prob_i = None
+        for loc_j, scale_j, log_scale_j in zip(torch.split(loc, block_size), torch.split(scale, block_size),
+                                               torch.split(log_scale, block_size)):
+            log_prob_ij = - (((samples_i.unsqueeze(1) - loc_j) / scale_j) ** 2 / 2 + log_scale_j).sum(-1) \
+                          - samples.shape[-1] * math.log(2 * math.pi) / 2
+            log_prob_ij = torch.logsumexp(log_prob_ij, dim=1)
+            log_prob_i = log_prob_ij if log_prob_i is None else torch.logaddexp(log_prob_i, log_prob_ij)
+        log_probs.append(log_prob_i)
+    return torch.cat(log_probs) - math.log(samples.shape[0])
+
+
 class SoftmaxBottleneck(nn.Module):
     def __init__(self, n_experts=4):
         super(SoftmaxBottleneck, self).__init__()
@@ -1,6 +1,8 @@
 import math
 import abc
+import inspect
 from collections import defaultdict
+from contextlib import contextmanager
 
 import torch
 import torch.nn as nn
@@ -9,11 +11,23 @@ from torch.nn.modules.transformer import TransformerEncoder, TransformerEncoderL
 import torch.nn.functional as F
 
 EPSILON = 1e-8
+# Whether the transformer modules take a hint that their attention mask is causal (torch>=2.0), which lets them use fused
+# causal attention kernels
+ENCODER_IS_CAUSAL = 'is_causal' in inspect.signature(TransformerEncoder.forward).parameters
+DECODER_IS_CAUSAL = 'tgt_is_causal' in inspect.signature(TransformerDecoder.forward).parameters
+# Fused attention kernels (torch>=2.0), used by the custom attention layers when available
+SDPA_AVAILABLE = hasattr(F, 'scaled_dot_product_attention')
+# Causal masks by (size, device, dtype), see causal_mask
+_causal_masks = {}
 
 
 # ============================================== BASE CLASSES ==========================================================
 
 class BaseLink(nn.Module):
+    # Links that can be fed only the new positions of their sequence inputs, while carrying whatever they need from the
+    # previous positions in prev_state/next_state, set this to True.
+    supports_incremental = False
+
     def __init__(self, input_size, output_size, z_size, depth, params, embedding=None, highway=False, dropout=0.,
                  batchnorm=False, residual=None):
         super(BaseLink, self).__init__()
@@ -29,6 +43,51 @@ class BaseLink(nn.Module):
         self.residual = residual
         self.prev_state = None
         self.next_state = None
+        self.incremental = False
+        self.quantized_embedding = None
+        # When set, training forward passes output the hidden states to be projected on the embedding matrix, instead
+        # of the projection itself, for criteria that only score part of the vocabulary (e.g. sampled softmax) or that
+        # do the projection themselves. Evaluation forward passes do too if eval_hidden_output is also set.
+        self.hidden_output = False
+        self.eval_hidden_output = False
+        self._embedding_t, self._embedding_t_key = None, None
+
+    def _generate_square_subsequent_mask(self, sz, device=None):
+        return causal_mask(sz, device if device is not None else next(self.parameters()).device)
+
+    def reorder_state(self, state, index):
+        # Selects the batch rows given by index in a state this link produced in next_state
+        return tuple(s.index_select(0, index) for s in state)
+
+    def project_on_embedding(self, hidden):
+        # Output projection of hidden states on the (tied) embedding matrix, done with its int8 copy if there is one.
+        # Outside of autograd, the transposed embedding matrix is kept contiguous in a cache that is refreshed whenever
+        # the embedding is updated or moved.
+        if self.quantized_embedding is not None:
+            return self.quantized_embedding(hidden)
+        weight = self.embedding.weight
+        if torch.is_grad_enabled():
+            return torch.matmul(hidden, weight.transpose(0, 1))
+        key = (weight.data_ptr(), weight._version)
+        if self._embedding_t_key != key:
+            self._embedding_t, self._embedding_t_key = weight.detach().transpose(0, 1).contiguous(), key
+        return torch.matmul(hidden, self._embedding_t)
+
+    def embedding_output(self, z_params):
+        # Projects the hidden states in z_params['logits'] on the embedding matrix, or moves them to z_params['hidden']
+        # if hidden_output is set (see __init__)
+        if self.hidden_output and (self.training or self.eval_hidden_output):
+            return {**{k: v for k, v in z_params.items() if k != 'logits'}, 'hidden': z_params['logits']}
+        return {**z_params, 'logits': self.project_on_embedding(z_params['logits'])}
+
+    def quantize_embedding_projection(self):
+        # Makes an int8 (per vocabulary row) copy of the embedding matrix for the output projection. The fp32 embedding
+        # is kept for the input representations, and is what gets trained and saved.
+        projection = nn.Linear(self.embedding.weight.shape[1], self.embedding.weight.shape[0], bias=False)
+        projection.weight.data.copy_(self.embedding.weight.data)
+        self.quantized_embedding = torch.quantization.quantize_dynamic(
+            nn.Sequential(projection), {nn.Linear: torch.quantization.per_channel_dynamic_qconfig},
+            dtype=torch.qint8)[0]
 
 
 class SequentialLink(BaseLink):
@@ -228,6 +287,8 @@ class LastStateMLPLink(BaseLink):
 
 
 class LSTMLink(BaseLink):
+    supports_incremental = True
+
     def __init__(self, input_size, output_size, z_size, depth, params, embedding=None, highway=False, sbn=None,
                  dropout=0., batchnorm=False, residual=None, last_state=False, bidirectional=False):
         super(LSTMLink, self).__init__(input_size, output_size, z_size, depth, params, embedding, highway,
@@ -253,6 +314,10 @@ class LSTMLink(BaseLink):
         else:
             self.hidden_to_z_params = nn.ModuleDict({param: nn.Linear(output_size, z_size) for param in params})
 
+    def reorder_state(self, state, index):
+        # The LSTM's (hidden, cell) states are batch-second
+        return tuple(s.index_select(1, index) for s in state)
+
     def forward(self, x, z_prev=None, lens=None):
         if self.residual is not None:
             x_res, x = x
@@ -474,7 +539,7 @@ class GRULink(SequentialLink):
             if self.sbn is not None:
                 z_params['logits'] = self.sbn(z_params['logits'], self.embedding.weight)
             else:
-                z_params['logits'] = torch.matmul(z_params['logits'], self.embedding.weight.transpose(0, 1))
+                z_params = self.embedding_output(z_params)
         if 'loc' in z_params and self.batchnorm:
             out_shape = z_params['loc'].shape
             z_params['loc'] = self.bn(z_params['loc'].view(-1, out_shape[-1])).view(out_shape)
@@ -517,9 +582,12 @@ class TransformerLink(BaseLink):
             x_res, x = x
             z_params_res = self.residual['link'](x_res, z_prev)
         x = self.input_to_hidden(x)
-        mask = None if self.bidirectional else self._generate_square_subsequent_mask(x.shape[-2])
+        mask = None if self.bidirectional else self._generate_square_subsequent_mask(x.shape[-2], x.device)
         x = self.pe(x.transpose(-2, 0))
-        outputs = self.transformer(x, mask=mask).transpose(-2, 0)
+        if mask is not None and ENCODER_IS_CAUSAL:
+            outputs = self.transformer(x, mask=mask, is_causal=True).transpose(-2, 0)
+        else:
+            outputs = self.transformer(x, mask=mask).transpose(-2, 0)
 
         z_params = {param: activation(self.hidden_to_z_params[param](outputs))+EPSILON for param, activation in
                     self.params.items()}
@@ -527,7 +595,7 @@ class TransformerLink(BaseLink):
             if self.sbn is not None:
                 z_params['logits'] = self.sbn(z_params['logits'], self.embedding.weight)
             else:
-                z_params['logits'] = torch.matmul(z_params['logits'], self.embedding.weight.transpose(0, 1))
+                z_params = self.embedding_output(z_params)
         if 'loc' in z_params and self.batchnorm:
             out_shape = z_params['loc'].shape
             z_params['loc'] = self.bn(z_params['loc'].view(-1, out_shape[-1])).view(out_shape)
@@ -540,16 +608,8 @@ class TransformerLink(BaseLink):
 
         return z_params
 
-    def _generate_square_subsequent_mask(self, sz):
-        device = next(self.parameters()).device
-        mask = (torch.triu(torch.ones(sz, sz, device=device)) == 1).transpose(0, 1)
-        mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
-        return mask
-
 
 class CoattentiveTransformerLink(NamedLink):
-    get_att = False
-
     def __init__(self, input_size, output_size, z_size, depth, params, embedding=None, highway=False, sbn=None,
                  dropout=0., batchnorm=False, residual=None, bidirectional=False, n_targets=20, nheads=2,
                  sequence=None, memory=None, n_mems=None, mem_size=None):
@@ -563,7 +623,8 @@ class CoattentiveTransformerLink(NamedLink):
         self.n_mems = n_mems
         self.memory = memory
         self.sequence = sequence
-        self.att_vals = None
+        # When set, forward passes record the cross-attention weights of each decoder layer in att_vals
+        self.record_att, self.att_vals = False, None
 
         self.input_to_hidden = nn.Linear(input_size, output_size)
         self.mem_to_hidden = nn.Linear(mem_size, output_size) if mem_size else None
@@ -629,14 +690,8 @@ class CoattentiveTransformerLink(NamedLink):
         assert all([ms == ts for ms, ts in zip(x.shape[1:], target.shape[1:])]), "Memory shape is {}, while  " \
                                                                                  "Target Shape is {}".format(x.shape,
                                                                                                              target.shape)
-        outputs = self.transformer_dec(memory=x, tgt=target).transpose(-2, 0)
-        if self.get_att:
-            self.att_vals = []
-            out = target
-            for mod in self.transformer_dec.layers:
-                self.att_vals.append(
-                mod.multihead_attn(out, x, x)[1])
-                out = mod(out, x)
+        with recording_cross_attention(self.transformer_dec, self.record_att) as self.att_vals:
+            outputs = self.transformer_dec(memory=x, tgt=target).transpose(-2, 0)
 
         z_params = {param: activation(self.hidden_to_z_params[param](outputs))+EPSILON for param, activation in
                     self.params.items()}
@@ -650,7 +705,7 @@ class CoattentiveTransformerLink(NamedLink):
             if self.sbn is not None:
                 z_params['logits'] = self.sbn(z_params['logits'], self.embedding.weight)
             else:
-                z_params['logits'] = torch.matmul(z_params['logits'], self.embedding.weight.transpose(0, 1))
+                z_params = self.embedding_output(z_params)
         if 'loc' in z_params and self.batchnorm:
             out_shape = z_params['loc'].shape
             z_params['loc'] = self.bn(z_params['loc'].view(-1, out_shape[-1])).view(out_shape)
@@ -662,17 +717,9 @@ class CoattentiveTransformerLink(NamedLink):
             z_params['loc'] = z_params_res['loc'] + z_params['loc']
         return z_params
 
-    def _generate_square_subsequent_mask(self, sz):
-        device = next(self.parameters()).device
-        mask = (torch.triu(torch.ones(sz, sz, device=device)) == 1).transpose(0, 1)
-        mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
-        return mask
-
 
 class CoattentiveTransformerLink2(NamedLink):
     # This one was made with modifications for the QKV project that don't affect the previous ADVAE project
-    get_att = False
-
     def __init__(self, input_size, output_size, z_size, depth, params, embedding=None, highway=False, sbn=None,
                  dropout=0., batchnorm=False, residual=None, bidirectional=False, n_targets=20, nheads=2,
                  sequence=None, memory=None, n_mems=None, mem_size=None):
@@ -686,7 +733,8 @@ class CoattentiveTransformerLink2(NamedLink):
         self.n_mems = n_mems
         self.memory = memory
         self.sequence = sequence
-        self.att_vals = None
+        # When set, forward passes record the cross-attention weights of each decoder layer in att_vals
+        self.record_att, self.att_vals = False, None
 
         self.input_to_hidden = nn.Linear(input_size, output_size)
         self.mem_to_hidden = nn.Linear(mem_size, output_size) if mem_size else None
@@ -753,14 +801,8 @@ class CoattentiveTransformerLink2(NamedLink):
         assert all([ms == ts for ms, ts in zip(x.shape[1:], target.shape[1:])]), "Memory shape is {}, while  " \
                                                                                  "Target Shape is {}".format(x.shape,
                                                                                                              target.shape)
-        outputs = self.transformer_dec(memory=x, tgt=target).transpose(-2, 0)
-        if self.get_att:
-            self.att_vals = []
-            out = target
-            for mod in self.transformer_dec.layers:
-                self.att_vals.append(
-                mod.multihead_attn(out, x, x)[1])
-                out = mod(out, x)
+        with recording_cross_attention(self.transformer_dec, self.record_att) as self.att_vals:
+            outputs = self.transformer_dec(memory=x, tgt=target).transpose(-2, 0)
 
         z_params = {param: activation(self.hidden_to_z_params[param](outputs))+EPSILON for param, activation in
                     self.params.items()}
@@ -774,7 +816,7 @@ class CoattentiveTransformerLink2(NamedLink):
             if self.sbn is not None:
                 z_params['logits'] = self.sbn(z_params['logits'], self.embedding.weight)
             else:
-                z_params['logits'] = torch.matmul(z_params['logits'], self.embedding.weight.transpose(0, 1))
+                z_params = self.embedding_output(z_params)
         if 'loc' in z_params and self.batchnorm:
             out_shape = z_params['loc'].shape
             z_params['loc'] = self.bn(z_params['loc'].view(-1, out_shape[-1])).view(out_shape)
@@ -786,15 +828,9 @@ class CoattentiveTransformerLink2(NamedLink):
             z_params['loc'] = z_params_res['loc'] + z_params['loc']
         return z_params
 
-    def _generate_square_subsequent_mask(self, sz):
-        device = next(self.parameters()).device
-        mask = (torch.triu(torch.ones(sz, sz, device=device)) == 1).transpose(0, 1)
-        mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
-        return mask
-
 
 class ConditionalCoattentiveTransformerLink(NamedLink):
-    get_att = False
+    supports_incremental = True
 
     def __init__(self, input_size, output_size, z_size, depth, params, embedding=None, highway=False, sbn=None,
                  dropout=0., batchnorm=False, residual=None, bidirectional=False, n_mems=20, memory=None, targets=None,
@@ -820,7 +856,8 @@ class ConditionalCoattentiveTransformerLink(NamedLink):
         self.bn = nn.BatchNorm1d(z_size)
         self.n_mems, self.output_size = n_mems, output_size
         self.bidirectional = bidirectional
-        self.att_vals = None
+        # When set, forward passes record the cross-attention weights of each decoder layer in att_vals
+        self.record_att, self.att_vals = False, None
 
         if embedding is not None:
             self.sbn = sbn
@@ -835,35 +872,26 @@ class ConditionalCoattentiveTransformerLink(NamedLink):
         assert self.residual is None, "Named links still can't have residuals"
 
     def forward(self, x, z_prev=None, lens=None):
-        memory = torch.cat([v for k, v in x.items() if k in self.memory], dim=-1)[..., 0, :]
-        memory = memory.view((*memory.shape[:-1], self.n_mems, self.mem_size))
-        memory = self.memory_to_hidden(memory)
         targets = torch.cat([v for k, v in x.items() if k in self.targets], dim=-1)
-
-        if memory.ndim > 3:
-            batch_orig_shape = memory.shape[:-2]
-            memory = memory.view(-1, *memory.shape[-2:])
-            targets = targets.view(-1, *targets.shape[-2:])
+        if self.incremental:
+            outputs, batch_orig_shape = self._incremental_forward(x, targets)
         else:
-            batch_orig_shape = None
-        targets = self.input_to_hidden(targets)
-        targets = self.pe(targets.transpose(-2, 0))
-        target_mask = self._generate_square_subsequent_mask(targets.shape[0]) if not self.bidirectional else None
-        # memory = self.pe(memory.transpose(-2, 0))
-        memory = memory.transpose(-2, 0)
-        memory = self.transformer_enc(memory)
-
-        # This conditioned is not checked by the transformer module architecture
-        assert all([ms == ts for ms, ts in zip(memory.shape[1:], targets.shape[1:])])
-        outputs = self.transformer_dec(memory=memory, tgt=targets, tgt_mask=target_mask).transpose(-2, 0)
+            memory, batch_orig_shape = self.encode_memory(x)
+            if batch_orig_shape is not None:
+                targets = targets.view(-1, *targets.shape[-2:])
+            targets = self.input_to_hidden(targets)
+            targets = self.pe(targets.transpose(-2, 0))
+            target_mask = self._generate_square_subsequent_mask(targets.shape[0], targets.device) \
+                if not self.bidirectional else None
 
-        if self.get_att:
-            self.att_vals = []
-            out = targets
-            for mod in self.transformer_dec.layers:
-                self.att_vals.append(
-                mod.multihead_attn(out, memory, memory)[1])
-                out = mod(out, x)
+            # This conditioned is not checked by the transformer module architecture
+            assert all([ms == ts for ms, ts in zip(memory.shape[1:], targets.shape[1:])])
+            with recording_cross_attention(self.transformer_dec, self.record_att) as self.att_vals:
+                if target_mask is not None and DECODER_IS_CAUSAL:
+                    outputs = self.transformer_dec(memory=memory, tgt=targets, tgt_mask=target_mask,
+                                                   tgt_is_causal=True).transpose(-2, 0)
+                else:
+                    outputs = self.transformer_dec(memory=memory, tgt=targets, tgt_mask=target_mask).transpose(-2, 0)
 
         z_params = {param: activation(self.hidden_to_z_params[param](outputs))+EPSILON for param, activation in
                     self.params.items()}
@@ -874,7 +902,7 @@ class ConditionalCoattentiveTransformerLink(NamedLink):
             if self.sbn is not None:
                 z_params['logits'] = self.sbn(z_params['logits'], self.embedding.weight)
             else:
-                z_params['logits'] = torch.matmul(z_params['logits'], self.embedding.weight.transpose(0, 1))
+                z_params = self.embedding_output(z_params)
         if 'loc' in z_params and self.batchnorm:
             out_shape = z_params['loc'].shape
             z_params['loc'] = self.bn(z_params['loc'].view(-1, out_shape[-1])).view(out_shape)
@@ -884,16 +912,51 @@ class ConditionalCoattentiveTransformerLink(NamedLink):
 
         return z_params
 
-    def _generate_square_subsequent_mask(self, sz):
-        device = next(self.parameters()).device
-        mask = (torch.triu(torch.ones(sz, sz, device=device)) == 1).transpose(0, 1)
-        mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
-        return mask
+    def encode_memory(self, x):
+        # Encodes the memory variables (sentence level, so only their first position is used) into the sequence-first
+        # memory [n_mems, batch, output_size] the decoder attends to. Also returns the original batch shape when the
+        # batch had to be flattened.
+        memory = torch.cat([v[..., 0, :] for k, v in x.items() if k in self.memory], dim=-1)
+        memory = memory.view((*memory.shape[:-1], self.n_mems, self.mem_size))
+        memory = self.memory_to_hidden(memory)
+        if memory.ndim > 3:
+            batch_orig_shape = memory.shape[:-2]
+            memory = memory.view(-1, *memory.shape[-2:])
+        else:
+            batch_orig_shape = None
+        # memory = self.pe(memory.transpose(-2, 0))
+        memory = memory.transpose(-2, 0)
+        return self.transformer_enc(memory), batch_orig_shape
+
+    def precompute_memory(self, x):
+        # Encodes the memory once for a whole incremental decoding, and returns the initial decoding state holding the
+        # cross-attention keys and values of each decoder layer
+        memory, _ = self.encode_memory(x)
+        return init_decoding_state(self.transformer_dec, memory)
+
+    def _incremental_forward(self, x, targets):
+        # Decodes the new target positions only. The memory is encoded at the first step, and the decoding state (in
+        # prev_state/next_state) keeps its cross-attention keys and values along with the self-attention cache of the
+        # previous positions.
+        assert not self.bidirectional, "Incremental decoding requires a unidirectional decoder"
+        state = self.prev_state if self.prev_state is not None else self.precompute_memory(x)
+        if targets.ndim > 3:
+            batch_orig_shape = targets.shape[:-2]
+            targets = targets.view(-1, *targets.shape[-2:])
+        else:
+            batch_orig_shape = None
+        past_len = state[0].shape[-2]
+        targets = self.input_to_hidden(targets)
+        targets = self.pe(targets.transpose(-2, 0), offset=past_len)
+        # The mask is built even for a single new position, so that traced decoding steps stay causal for any number of
+        # new positions
+        target_mask = incremental_causal_mask(past_len, targets.shape[0], targets.device)
+        outputs, self.next_state = incremental_decoder_forward(self.transformer_dec, targets, state,
+                                                               tgt_mask=target_mask)
+        return outputs.transpose(-2, 0), batch_orig_shape
 
 
 class ConditionalCoattentiveQKVTransformerLink(NamedLink):
-    get_att = False
-
     def __init__(self, input_size, output_size, z_size, depth, params, embedding=None, highway=False, sbn=None,
                  dropout=0., batchnorm=False, residual=None, bidirectional=False, n_mems=20, n_keys=1, memory=None,
                  key=None, targets=None, nheads=2, minimal_enc=False, mem_size=None, old_ver=False,
@@ -947,7 +1010,8 @@ class ConditionalCoattentiveQKVTransformerLink(NamedLink):
         self.bn = nn.BatchNorm1d(z_size)
         self.n_mems, self.output_size = n_mems, output_size
         self.bidirectional = bidirectional
-        self.att_vals = None
+        # When set, forward passes record the cross-attention weights of each decoder layer in att_vals
+        self.record_att, self.att_vals = False, None
 
         if embedding is not None:
             self.sbn = sbn
@@ -986,7 +1050,8 @@ class ConditionalCoattentiveQKVTransformerLink(NamedLink):
             batch_orig_shape = None
         targets = self.input_to_hidden(targets)
         targets = self.pe(targets.transpose(-2, 0))
-        target_mask = self._generate_square_subsequent_mask(targets.shape[0]) if not self.bidirectional else None
+        target_mask = self._generate_square_subsequent_mask(targets.shape[0], targets.device) \
+            if not self.bidirectional else None
         # memory = self.pe(memory.transpose(-2, 0))
         memory = memory.transpose(-2, 0)
         # memory = self.transformer_enc(memory)
@@ -998,15 +1063,8 @@ class ConditionalCoattentiveQKVTransformerLink(NamedLink):
 
         # This conditioned is not checked by the transformer module architecture
         assert all([ms == ts for ms, ts in zip(memory.shape[1:], targets.shape[1:])])
-        outputs = self.transformer_dec(memory=memory, tgt=targets, key=key, tgt_mask=target_mask).transpose(-2, 0)
-
-        if self.get_att:
-            self.att_vals = []
-            out = targets
-            for mod in self.transformer_dec.layers:
-                self.att_vals.append(
-                mod.multihead_attn(out, memory, memory)[1])
-                out = mod(out, x)
+        with recording_cross_attention(self.transformer_dec, self.record_att) as self.att_vals:
+            outputs = self.transformer_dec(memory=memory, tgt=targets, key=key, tgt_mask=target_mask).transpose(-2, 0)
 
         z_params = {param: activation(self.hidden_to_z_params[param](outputs))+EPSILON for param, activation in
                     self.params.items()}
@@ -1017,7 +1075,7 @@ class ConditionalCoattentiveQKVTransformerLink(NamedLink):
             if self.sbn is not None:
                 z_params['logits'] = self.sbn(z_params['logits'], self.embedding.weight)
             else:
-                z_params['logits'] = torch.matmul(z_params['logits'], self.embedding.weight.transpose(0, 1))
+                z_params = self.embedding_output(z_params)
         if 'loc' in z_params and self.batchnorm:
             out_shape = z_params['loc'].shape
             z_params['loc'] = self.bn(z_params['loc'].view(-1, out_shape[-1])).view(out_shape)
@@ -1027,12 +1085,6 @@ class ConditionalCoattentiveQKVTransformerLink(NamedLink):
 
         return z_params
 
-    def _generate_square_subsequent_mask(self, sz):
-        device = next(self.parameters()).device
-        mask = (torch.triu(torch.ones(sz, sz, device=device)) == 1).transpose(0, 1)
-        mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
-        return mask
-
 
 class ConditionalCoattentiveTransformerLink2(NamedLink):
     def __init__(self, input_size, output_size, z_size, depth, params, embedding=None, highway=False, sbn=None,
@@ -1092,7 +1144,8 @@ class ConditionalCoattentiveTransformerLink2(NamedLink):
             batch_orig_shape = None
 
         targets = self.pe(targets.transpose(-2, 0))
-        target_mask = self._generate_square_subsequent_mask(targets.shape[0]) if not self.bidirectional else None
+        target_mask = self._generate_square_subsequent_mask(targets.shape[0], targets.device) \
+            if not self.bidirectional else None
         if self.memory is not None:
             memory = torch.cat([v for k, v in x.items() if k in self.memory], dim=-1)[..., 0, :]
             memory = memory.view((*memory.shape[:-1], self.sn_mems, self.output_size))
@@ -1105,7 +1158,13 @@ class ConditionalCoattentiveTransformerLink2(NamedLink):
 
             # This conditioned is not checked by the transformer module architecture
             assert all([ms == ts for ms, ts in zip(memory.shape[1:], targets.shape[1:])])
-            outputs = self.transformer_dec(memory=memory, tgt=targets, tgt_mask=target_mask).transpose(-2, 0)
+            if target_mask is not None and DECODER_IS_CAUSAL:
+                outputs = self.transformer_dec(memory=memory, tgt=targets, tgt_mask=target_mask,
+                                               tgt_is_causal=True).transpose(-2, 0)
+            else:
+                outputs = self.transformer_dec(memory=memory, tgt=targets, tgt_mask=target_mask).transpose(-2, 0)
+        elif target_mask is not None and ENCODER_IS_CAUSAL:
+            outputs = self.transformer_dec(targets, mask=target_mask, is_causal=True).transpose(-2, 0)
         else:
             outputs = self.transformer_dec(targets, mask=target_mask).transpose(-2, 0)
         z_params = {param: activation(self.hidden_to_z_params[param](outputs))+EPSILON for param, activation in
@@ -1121,7 +1180,7 @@ class ConditionalCoattentiveTransformerLink2(NamedLink):
             if self.sbn is not None:
                 z_params['logits'] = self.sbn(z_params['logits'], self.embedding.weight)
             else:
-                z_params['logits'] = torch.matmul(z_params['logits'], self.embedding.weight.transpose(0, 1))
+                z_params = self.embedding_output(z_params)
         if 'loc' in z_params and self.batchnorm:
             out_shape = z_params['loc'].shape
             z_params['loc'] = self.bn(z_params['loc'].view(-1, out_shape[-1])).view(out_shape)
@@ -1131,12 +1190,6 @@ class ConditionalCoattentiveTransformerLink2(NamedLink):
 
         return z_params
 
-    def _generate_square_subsequent_mask(self, sz):
-        device = next(self.parameters()).device
-        mask = (torch.triu(torch.ones(sz, sz, device=device)) == 1).transpose(0, 1)
-        mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
-        return mask
-
 
 class PositionalEncoding(nn.Module):
     # Took this snippet from https://pytorch.org/tutorials/beginner/transformer_tutorial.html
@@ -1151,8 +1204,8 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0).transpose(0, 1)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        return x + self.pe[:x.size(0), :]
+    def forward(self, x, offset=0):
+        return x + self.pe[offset:offset+x.size(0), :]
 
 
 class SpecialTransformerEncoder(TransformerEncoderLayer):
@@ -1163,23 +1216,31 @@ class SpecialTransformerEncoder(TransformerEncoderLayer):
                                  nn.Embedding(n_mems, int(d_model/2)).weight
         self.linear0 = torch.nn.Linear(d_model, int(d_model/2))
 
-    def forward(self, src, src_mask=None, src_key_padding_mask=None):
+    def forward(self, src, src_mask=None, src_key_padding_mask=None, is_causal=False):
         r"""Pass the input through the encoder layer.
 
         Args:
             src: the sequnce to the encoder layer (required).
             src_mask: the mask for the src sequence (optional).
             src_key_padding_mask: the mask for the src keys per batch (optional).
+            is_causal: hint that src_mask is the causal mask (optional).
 
         Shape:
             see the docs in Transformer class.
         """
-        q = self.q.unsqueeze(1).expand(self.q.shape[0], src.shape[1], self.q.shape[1])
-        k = self.k.unsqueeze(1).expand(self.k.shape[0], src.shape[1], self.k.shape[1])
-        v = self.v.unsqueeze(1).expand(self.v.shape[0], src.shape[1], self.v.shape[1])
-        src1 = self.linear0(src)
-        src2 = self.self_attn(torch.cat([src1, q], -1), torch.cat([src1, k], -1), torch.cat([src1, v], -1),
-                              attn_mask=src_mask, key_padding_mask=src_key_padding_mask)[0]
+        # The attention inputs are the concatenations of linear0(src) with the learned memory embeddings, so each of
+        # their projections is the sum of a projection of linear0(src) and of a (batch independent) projection of the
+        # learned embeddings, which is only computed once
+        attn, src1 = self.self_attn, self.linear0(src)
+        d_model, half = attn.embed_dim, src1.shape[-1]
+        heads = []
+        for i, learned in enumerate([self.q, self.k, self.v]):
+            weight = attn.in_proj_weight[i*d_model:(i+1)*d_model]
+            bias = attn.in_proj_bias[i*d_model:(i+1)*d_model] if attn.in_proj_bias is not None else None
+            x = F.linear(src1, weight[:, :half], bias) + F.linear(learned, weight[:, half:]).unsqueeze(1)
+            heads.append(x.view(*x.shape[:2], attn.num_heads, int(d_model/attn.num_heads)).permute(1, 2, 0, 3))
+        src2 = _mha_attend(attn, *heads, attn_mask=src_mask, key_padding_mask=src_key_padding_mask,
+                           is_causal=is_causal)
         src = src + self.dropout1(src2)
         src = self.norm1(src)
         if hasattr(self, "activation"):
@@ -1208,12 +1269,13 @@ class QKVTransformerDecoderLayer(TransformerDecoderLayer):
         Shape:
             see the docs in Transformer class.
         """
-        tgt2 = self.self_attn(tgt, tgt, tgt, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
+        tgt2 = _mha_attend(self.self_attn, *[_mha_projection(self.self_attn, tgt, i) for i in range(3)],
+                           attn_mask=tgt_mask, key_padding_mask=tgt_key_padding_mask)
         tgt = tgt + self.dropout1(tgt2)
         tgt = self.norm1(tgt)
-        tgt2 = self.multihead_attn(tgt, key, memory, attn_mask=memory_mask,
-                                   key_padding_mask=memory_key_padding_mask)[0]
+        tgt2 = _mha_attend(self.multihead_attn, _mha_projection(self.multihead_attn, tgt, 0),
+                           _mha_projection(self.multihead_attn, key, 1), _mha_projection(self.multihead_attn, memory, 2),
+                           attn_mask=memory_mask, key_padding_mask=memory_key_padding_mask)
         tgt = tgt + self.dropout2(tgt2)
         tgt = self.norm2(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt))))
@@ -1248,3 +1310,137 @@ class MinimalTransformerEncoder(nn.Module):
     def forward(self, src):
         embs = self.embs.unsqueeze(1).expand(self.embs.shape[0], src.shape[1], self.embs.shape[1])
         return src+embs
+
+
+# ================================================ ATTENTION MASKS =====================================================
+
+def causal_mask(sz, device, dtype=torch.float):
+    # Additive causal attention mask (0 on and below the diagonal, -inf above), built once for each size, device and dtype
+    # and shared by all links. It must not be modified in place.
+    key = (sz, torch.device(device), dtype)
+    if key not in _causal_masks:
+        _causal_masks[key] = torch.full((sz, sz), float('-inf'), device=device, dtype=dtype).triu(1)
+    return _causal_masks[key]
+
+
+def incremental_causal_mask(past_len, n_new, device, dtype=torch.float):
+    # Rows of the additive causal mask for n_new positions following past_len ones ([n_new, past_len+n_new]). Unlike
+    # slices of causal_mask, it is built from position indices, so that it follows both sizes when traced.
+    query_pos = torch.arange(n_new, device=device).unsqueeze(-1) + past_len
+    key_pos = torch.arange(past_len + n_new, device=device).unsqueeze(0)
+    return torch.zeros(n_new, past_len + n_new, device=device, dtype=dtype).masked_fill(key_pos > query_pos,
+                                                                                        float('-inf'))
+
+
+# ============================================== ATTENTION RECORDING ===================================================
+
+@contextmanager
+def recording_cross_attention(decoder, enabled=True):
+    # Yields the list to which the cross-attention weights [B, L_tgt, L_mem] (averaged over heads) of each layer of the
+    # decoder are appended during its forward passes inside the context, or None if not enabled.
+    if not enabled:
+        yield None
+        return
+    records = []
+    modules = [layer.multihead_attn for layer in decoder.layers]
+    for attn in modules:
+        attn.att_records = records
+        if isinstance(attn, nn.MultiheadAttention):
+            attn.forward = _recording_mha_forward(attn)
+    try:
+        yield records
+    finally:
+        for attn in modules:
+            del attn.att_records
+            if 'forward' in attn.__dict__:
+                del attn.forward
+
+
+def _recording_mha_forward(attn):
+    # Forward of a MultiheadAttention module that also returns and records its weights, even when its caller doesn't
+    # need them
+    def forward(*args, **kwargs):
+        kwargs['need_weights'] = True
+        outputs = nn.MultiheadAttention.forward(attn, *args, **kwargs)
+        attn.att_records.append(outputs[1])
+        return outputs
+    return forward
+
+
+# ============================================== INCREMENTAL DECODING ==================================================
+
+def _mha_projection(attn, x, i):
+    # Projects x [L, B, D] with the i-th (0: query, 1: key, 2: value) part of the packed input projection of a
+    # MultiheadAttention module, and splits the result in heads [B, H, L, D/H]
+    d_model = attn.embed_dim
+    bias = attn.in_proj_bias[i*d_model:(i+1)*d_model] if attn.in_proj_bias is not None else None
+    x = F.linear(x, attn.in_proj_weight[i*d_model:(i+1)*d_model], bias)
+    return x.view(*x.shape[:2], attn.num_heads, int(d_model/attn.num_heads)).permute(1, 2, 0, 3)
+
+
+def _mha_attend(attn, q, k, v, attn_mask=None, key_padding_mask=None, is_causal=False):
+    # Attention over already projected heads [B, H, L, D/H], followed by the output projection of the MultiheadAttention
+    # module. Masks follow MultiheadAttention's conventions (additive float masks, or boolean ones that are True where
+    # attention is prevented). With is_causal, attn_mask is taken to be the causal mask.
+    if key_padding_mask is None and is_causal:
+        attn_mask = None
+    else:
+        is_causal = False
+        if attn_mask is not None and attn_mask.dtype == torch.bool:
+            attn_mask = torch.zeros(attn_mask.shape, dtype=q.dtype, device=q.device).masked_fill(attn_mask,
+                                                                                                float('-inf'))
+        if key_padding_mask is not None:
+            padding_mask = torch.zeros(key_padding_mask.shape, dtype=q.dtype, device=q.device).masked_fill(
+                key_padding_mask.bool(), float('-inf'))[:, None, None, :]
+            attn_mask = padding_mask if attn_mask is None else attn_mask + padding_mask
+        attn_mask = attn_mask.to(q.dtype) if attn_mask is not None else None
+    dropout = attn.dropout if attn.training else 0.
+    records = getattr(attn, 'att_records', None)
+    if SDPA_AVAILABLE and records is None:
+        outputs = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout, is_causal=is_causal)
+    else:
+        weights = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(q.shape[-1])
+        if is_causal:
+            attn_mask = causal_mask(q.shape[-2], q.device, q.dtype)
+        if attn_mask is not None:
+            weights = weights + attn_mask
+        weights = torch.softmax(weights, dim=-1)
+        if records is not None:
+            records.append(weights.mean(1))
+        outputs = torch.matmul(F.dropout(weights, p=dropout, training=attn.training), v)
+    outputs = outputs.permute(2, 0, 1, 3)
+    return attn.out_proj(outputs.reshape(*outputs.shape[:2], attn.embed_dim))
+
+
+def init_decoding_state(decoder, memory):
+    # Initial state of incremental_decoder_forward: for each layer, empty self-attention keys and values followed by the
+    # cross-attention keys and values of the encoded memory [M, B, D], which are only computed once per decoding.
+    state = []
+    for mod in decoder.layers:
+        mem_k, mem_v = _mha_projection(mod.multihead_attn, memory, 1), _mha_projection(mod.multihead_attn, memory, 2)
+        state.extend([mem_k[..., :0, :], mem_v[..., :0, :], mem_k, mem_v])
+    return tuple(state)
+
+
+def incremental_decoder_forward(decoder, tgt, state, tgt_mask=None):
+    # Runs a TransformerDecoder made of (post-norm) TransformerDecoderLayers on the new target positions tgt [L, B, D]
+    # only. For each layer, state holds the self-attention keys and values [B, H, L_past, D/H] of the previous positions
+    # and the cross-attention keys and values [B, H, M, D/H] of the memory (see init_decoding_state). Returns the new
+    # positions' outputs and the updated state.
+    output, new_state = tgt, []
+    for i, mod in enumerate(decoder.layers):
+        k, v, mem_k, mem_v = state[4*i:4*(i+1)]
+        k = torch.cat([k, _mha_projection(mod.self_attn, output, 1)], dim=-2)
+        v = torch.cat([v, _mha_projection(mod.self_attn, output, 2)], dim=-2)
+        new_state.extend([k, v, mem_k, mem_v])
+        tgt2 = _mha_attend(mod.self_attn, _mha_projection(mod.self_attn, output, 0), k, v, attn_mask=tgt_mask)
+        output = mod.norm1(output + mod.dropout1(tgt2))
+        tgt2 = _mha_attend(mod.multihead_attn, _mha_projection(mod.multihead_attn, output, 0), mem_k, mem_v)
+        output = mod.norm2(output + mod.dropout2(tgt2))
+        tgt2 = mod.linear2(mod.dropout(mod.activation(mod.linear1(output))))
+        output = mod.norm3(output + mod.dropout3(tgt2))
+
+    if decoder.norm is not None:
+        output = decoder.norm(output)
+
+    return output, tuple(new_state)
@@ -0,0 +1,105 @@
+# This file serves a trained model locally (see disentanglement_transformer/serving.py for the endpoints)
+import argparse
+import asyncio
+
+from torch import device
+import torch
+from torch import optim
+from torchtext.data import BucketIterator
+
+from data_prep import NLIGenData2, OntoGenData, HuggingYelp2
+from disentanglement_transformer.models import DisentanglementTransformerVAE
+from disentanglement_transformer.h_params import DefaultTransformerHParams as HParams
+from disentanglement_transformer.graphs import *
+from disentanglement_transformer.serving import InferenceService, serve
+from disentanglement_transformer.quantization import quantization_report
+from components.criteria import *
+parser = argparse.ArgumentParser()
+# Model (must match the flags the checkpoint was trained with)
+k, kz, klstm = 1, 8, 2
+parser.add_argument("--test_name", default='unnamed', type=str)
+parser.add_argument("--data", default='nli', choices=["nli", "ontonotes", "yelp"], type=str)
+parser.add_argument("--max_len", default=17, type=int)
+parser.add_argument("--device", default='cpu', choices=["cuda:0", "cuda:1", "cuda:2", "cpu"], type=str)
+parser.add_argument("--embedding_dim", default=128, type=int)
+parser.add_argument("--z_size", default=96*kz, type=int)
+parser.add_argument("--z_emb_dim", default=192*k, type=int)
+parser.add_argument("--n_latents", default=[4], nargs='+', type=int)
+parser.add_argument("--text_rep_l", default=3, type=int)
+parser.add_argument("--text_rep_h", default=192*k, type=int)
+parser.add_argument("--encoder_h", default=192*k, type=int)
+parser.add_argument("--encoder_l", default=2, type=int)
+parser.add_argument("--decoder_h", default=192*k, type=int)
+parser.add_argument("--decoder_l", default=2, type=int)
+parser.add_argument("--highway", default=False, type=bool)
+parser.add_argument("--markovian", default=True, type=bool)
+parser.add_argument('--minimal_enc', dest='minimal_enc', action='store_true')
+parser.add_argument('--no-minimal_enc', dest='minimal_enc', action='store_false')
+parser.set_defaults(minimal_enc=False)
+parser.add_argument("--graph", default='IndepInfer', choices=["Vanilla", "Discrete", "IndepInfer", "Normal", "NormalConGen",
+                                                          "NormalSimplePrior", "Normal2",  "NormalLSTM"], type=str)
+# Serving
+parser.add_argument("--host", default='127.0.0.1', type=str)
+parser.add_argument("--port", default=8000, type=int)
+parser.add_argument("--unix_socket", default=None, type=str)
+parser.add_argument("--max_batch_size", default=64, type=int)
+parser.add_argument("--max_wait_ms", default=10., type=float)
+parser.add_argument("--n_threads", default=None, type=int)
+parser.add_argument('--quantize', dest='quantize', action='store_true')
+parser.add_argument('--check_quantization', dest='check_quantization', action='store_true')
+parser.set_defaults(quantize=False, check_quantization=False)
+
+flags = parser.parse_args()
+
+GRAPH = {"Vanilla": get_vanilla_graph,
+         "Discrete": get_discrete_auto_regressive_graph,
+         "IndepInfer": get_structured_auto_regressive_indep_graph,
+         "Normal": get_structured_auto_regressive_graph,
+         "NormalConGen": get_structured_auto_regressive_graphConGen,
+         "Normal2": get_structured_auto_regressive_graph2,
+         "NormalLSTM": get_lstm_graph,
+         "NormalSimplePrior": get_structured_auto_regressive_simple_prior}[flags.graph]
+if flags.graph == "NormalLSTM":
+    flags.encoder_h = int(flags.encoder_h/k*klstm)
+if flags.graph == "Vanilla":
+    flags.n_latents = [flags.z_size]
+Data = {"nli": NLIGenData2, "ontonotes": OntoGenData, "yelp": HuggingYelp2}[flags.data]
+DEVICE = device(flags.device)
+if flags.n_threads is not None:
+    torch.set_num_threads(flags.n_threads)
+
+
+def main():
+    # The vocabulary is rebuilt from the training data, as in disentangle_train.py
+    data = Data(flags.max_len, 1, 1, DEVICE, pretrained=False)
+    h_params = HParams(len(data.vocab.itos), len(data.tags.itos) if flags.data == 'yelp' else None, flags.max_len, 1, 1,
+                       device=DEVICE, vocab_ignore_index=data.vocab.stoi['<pad>'], decoder_h=flags.decoder_h,
+                       decoder_l=flags.decoder_l, encoder_h=flags.encoder_h, encoder_l=flags.encoder_l,
+                       text_rep_h=flags.text_rep_h, text_rep_l=flags.text_rep_l, test_name=flags.test_name,
+                       optimizer_kwargs={'lr': 0.}, is_weighted=[], graph_generator=GRAPH, z_size=flags.z_size,
+                       embedding_dim=flags.embedding_dim, highway=flags.highway, losses=[ELBo], loss_params=[1],
+                       optimizer=optim.AdamW, markovian=flags.markovian, contiguous_lm=False,
+                       n_latents=flags.n_latents, z_emb_dim=flags.z_emb_dim, minimal_enc=flags.minimal_enc)
+    model = DisentanglementTransformerVAE(data.vocab, data.tags, h_params, dataset=flags.data)
+    if DEVICE.type == 'cuda':
+        model.cuda(DEVICE)
+    model.eval()
+    if flags.quantize:
+        if flags.check_quantization:
+            fp32_model = DisentanglementTransformerVAE(data.vocab, data.tags, h_params, dataset=flags.data)
+            model.quantize()
+            # The data was only loaded for its vocabulary, the check runs on validation batches of the served size
+            data.val_iter = BucketIterator(data.val_iter.dataset, batch_size=flags.max_batch_size, device=DEVICE,
+                                           shuffle=False, sort=False)
+            if not quantization_report(fp32_model, model, data)['accepted']:
+                print("Serving the quantized model despite its accuracy loss")
+            del fp32_model
+        else:
+            model.quantize()
+
+    service = InferenceService(model, max_batch_size=flags.max_batch_size, max_wait=flags.max_wait_ms/1000)
+    asyncio.run(serve(service, host=flags.host, port=flags.port, unix_socket=flags.unix_socket))
+
+
+if __name__ == '__main__':
+    main()
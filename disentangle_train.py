@@ -49,6 +49,7 @@ parser.add_argument("--graph", default='IndepInfer', choices=["Vanilla", "Discre
                                                           "NormalSimplePrior", "Normal2",  "NormalLSTM"], type=str)
 parser.add_argument("--training_iw_samples", default=1, type=int)
 parser.add_argument("--testing_iw_samples", default=20, type=int)
+parser.add_argument("--iw_chunk_size", default=0, type=int)  # IW samples scored at once by the IWLBo, 0 for all of them
 parser.add_argument("--test_prior_samples", default=10, type=int)
 parser.add_argument("--anneal_kl0", default=3000, type=int)
 parser.add_argument("--anneal_kl1", default=6000, type=int)
@@ -65,6 +66,12 @@ parser.add_argument("--lr", default=2e-4, type=float)
 parser.add_argument("--lr_reduction", default=4., type=float)
 parser.add_argument("--wait_epochs", default=1, type=float)
 parser.add_argument("--save_all", default=True, type=bool)
+parser.add_argument("--sampled_softmax", default=0, type=int)  # Number of negative samples, 0 for the full softmax
+parser.add_argument("--vocab_chunk_size", default=0, type=int)  # Fused output projection chunk size, 0 to disable
+parser.add_argument("--log_every", default=1, type=int)  # Training steps between two dumps of the training metrics
+parser.add_argument('--compile', dest='compile', action='store_true')
+parser.add_argument("--compile_backend", default='inductor', type=str)
+parser.set_defaults(compile=False)
 
 flags = parser.parse_args()
 
@@ -114,6 +121,10 @@ if flags.device.startswith('cuda'):
 LOSSES = {'IWAE': [IWLBo],
           'VAE': [ELBo],
           'LagVAE': [ELBo]}[flags.losses]
+if flags.sampled_softmax:
+    assert flags.losses != 'IWAE', "Sampled softmax is only implemented for the ELBo"
+    assert not flags.vocab_chunk_size, "Sampled softmax can't be used with the fused output projection"
+    LOSSES = [SampledSoftmaxELBo]
 
 ANNEAL_KL = [flags.anneal_kl0*flags.grad_accu, flags.anneal_kl1*flags.grad_accu]
 LOSS_PARAMS = [1]
@@ -134,11 +145,14 @@ def main():
                        z_size=flags.z_size, embedding_dim=flags.embedding_dim, anneal_kl=ANNEAL_KL,
                        grad_clip=flags.grad_clip*flags.grad_accu, kl_th=flags.kl_th, highway=flags.highway,
                        losses=LOSSES, dropout=flags.dropout, training_iw_samples=flags.training_iw_samples,
-                       testing_iw_samples=flags.testing_iw_samples, loss_params=LOSS_PARAMS, optimizer=optim.AdamW,
+                       testing_iw_samples=flags.testing_iw_samples, iw_chunk_size=flags.iw_chunk_size or None,
+                       loss_params=LOSS_PARAMS, optimizer=optim.AdamW,
                        markovian=flags.markovian, word_dropout=flags.word_dropout, contiguous_lm=False,
                        test_prior_samples=flags.test_prior_samples, n_latents=flags.n_latents,
                        max_elbo=[flags.max_elbo_choice, flags.max_elbo1],  # max_elbo is paper's beta
-                       z_emb_dim=flags.z_emb_dim, minimal_enc=flags.minimal_enc, kl_beta=flags.kl_beta)
+                       z_emb_dim=flags.z_emb_dim, minimal_enc=flags.minimal_enc, kl_beta=flags.kl_beta,
+                       sampled_softmax=flags.sampled_softmax, log_every=flags.log_every,
+                       vocab_chunk_size=flags.vocab_chunk_size or None)
     val_iterator = iter(data.val_iter)
     print("Words: ", len(data.vocab.itos), ", On device: ", DEVICE.type)
     print("Loss Type: ", flags.losses)
@@ -149,6 +163,8 @@ def main():
         model = DisentanglementTransformerVAE(data.vocab, data.tags, h_params, wvs=data.wvs, dataset=flags.data)
     if DEVICE.type == 'cuda':
         model.cuda(DEVICE)
+    if flags.compile:
+        model.compile_networks(backend=flags.compile_backend)
 
     total_unsupervised_train_samples = len(data.train_iter)*BATCH_SIZE
     total_unsupervised_val_samples = len(data.val_iter)*BATCH_SIZE
@@ -170,6 +186,8 @@ def main():
     mean_loss = 0
     stabilize_epochs = 0
     prev_mi = 0
+    # Step times after the first step, which also compiles the networks with --compile
+    steady_time, steady_steps, first_step = 0., 0, True
     # model.eval()
     # model.get_disentanglement_summaries2(data.test_iter, 200)
     # print(model.get_perplexity(data.val_iter))
@@ -185,12 +203,24 @@ def main():
                     print('Saved model after it\'s pure reconstruction phase')
 
             # print([' '.join([data.vocab.itos[t] for t in text_i]) for text_i in training_batch.text[:2]])
-            loss = model.opt_step({'x': training_batch.text[..., 1:], 'x_prev': training_batch.text[..., :-1]})
+            step_start = time()
+            loss = model.opt_step({'x': training_batch.text[..., 1:], 'x_prev': training_batch.text[..., :-1],
+                                   'text': training_batch.text})
+            if first_step:
+                if flags.compile:
+                    compile_time = model.compilation_report()
+                    print("First step: {:.2f}s, of which {:.2f}s compiling forward passes".format(time()-step_start,
+                                                                                             compile_time))
+                first_step = False
+            else:
+                steady_time += time() - step_start
+                steady_steps += 1
 
             mean_loss += loss
             if i % 30 == 0:
                 mean_loss /= 30
-                print("step:{}, loss:{}, seconds/step:{}".format(model.step, mean_loss, time()-current_time))
+                print("step:{}, loss:{}, seconds/step:{}, mean steady-state seconds/step:{}".format(
+                    model.step, mean_loss, time()-current_time, steady_time/max(steady_steps, 1)))
                 mean_loss = 0
             if int(model.step / (len(LOSSES))) % TEST_FREQ == TEST_FREQ-1:
                 model.eval()
@@ -202,7 +232,7 @@ def main():
                     val_iterator = iter(data.val_iter)
                     test_batch = limited_next(val_iterator)
                 with torch.no_grad():
-                    model({'x': test_batch.text[..., 1:], 'x_prev': test_batch.text[..., :-1]})
+                    model({'x': test_batch.text[..., 1:], 'x_prev': test_batch.text[..., :-1], 'text': test_batch.text})
                 model.dump_test_viz(complete=int(model.step / (len(LOSSES))) %
                                     COMPLETE_TEST_FREQ == COMPLETE_TEST_FREQ-1)
                 model.train()
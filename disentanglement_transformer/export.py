@@ -0,0 +1,106 @@
+# This file exports the inference and generation networks of a trained DisentanglementTransformerVAE as plain modules
+# with fixed tensor inputs and outputs, which are traced to TorchScript and ONNX. Generation is split into a memory
+# encoder, run once per sentence on its latent vectors, and a decoding step, run for each generated token:
+#   z1, ..., zn = encoder(x)                          (x: [batch, len] token ids, without the <go> token)
+#   state = memory_encoder(z1, ..., zn)
+#   logits, state = decoder_step(x_new, *state)       (x_new: [batch, n_new] token ids, logits: [batch, vocab_size])
+# where the n_new tokens of x_new (e.g. a prompt prefix, or the last generated token) attend causally to each other.
+import os
+
+import torch
+import torch.nn as nn
+
+from components.bayesnets import StaticBayesNet
+
+
+# ================================================ EXPORTED MODULES ====================================================
+
+class Encoder(nn.Module):
+    # Returns the posterior means [batch, z_size] of the latent variables
+    def __init__(self, model):
+        super(Encoder, self).__init__()
+        self.z_names = ['z{}'.format(i+1) for i in range(len(model.h_params.n_latents))]
+        self.net = StaticBayesNet(model.infer_bn, [lv.name for lv in model.infer_bn.input_variables], self.z_names)
+        self.input_names = self.net.input_names
+
+    def forward(self, *inputs):
+        return tuple(z[..., 0, :] for z in self.net(*inputs))
+
+
+class MemoryEncoder(nn.Module):
+    # Returns the initial decoding state of the generation network's decoder from the latent variables [batch, z_size]
+    def __init__(self, model):
+        super(MemoryEncoder, self).__init__()
+        self.link = model.gen_bn.approximator[model.generated_v]
+        if not (self.link.supports_incremental and hasattr(self.link, 'precompute_memory')):
+            raise NotImplementedError("Only decoders with a precomputed memory can be exported")
+        self.z_names = list(self.link.memory)
+        self.variables = nn.ModuleDict({name: model.gen_bn.name_to_v[name] for name in self.z_names})
+
+    def forward(self, *zs):
+        return self.link.precompute_memory({name: self.variables[name].rep(z.unsqueeze(-2), step_wise=False)
+                                            for name, z in zip(self.z_names, zs)})
+
+
+class DecoderStep(nn.Module):
+    # Decodes the new tokens given the decoding state, and returns the next token logits with the updated state
+    def __init__(self, model):
+        super(DecoderStep, self).__init__()
+        self.link = model.gen_bn.approximator[model.generated_v]
+        if not self.link.supports_incremental:
+            raise NotImplementedError("Only decoders that support incremental decoding can be exported")
+        self.variables = nn.ModuleDict({name: model.gen_bn.name_to_v[name] for name in self.link.targets})
+
+    def forward(self, x_new, *state):
+        self.link.prev_state, self.link.incremental = state, True
+        params = self.link({name: self.variables[name].rep(x_new, step_wise=False) for name in self.variables})
+        state = self.link.next_state
+        self.link.prev_state, self.link.next_state, self.link.incremental = None, None, False
+        return (params['logits'][..., -1, :], *state)
+
+
+# ==================================================== EXPORT ==========================================================
+
+def export_networks(model, path, example_text, formats=('torchscript', 'onnx'), opset_version=13):
+    # Traces the exported modules of model on example_text (a batch of <go> ... <eos> token sequences), and saves them
+    # to <path>_{encoder,memory_encoder,decoder_step}.{pt,onnx}, along with the vocabulary in <path>_vocab.txt
+    assert example_text.shape[-1] >= 3, "The example sequences must have at least 3 tokens"
+    model.eval()
+    encoder, memory_encoder, decoder_step = Encoder(model), MemoryEncoder(model), DecoderStep(model)
+    samples = {'x': example_text[..., 1:], 'x_prev': example_text[..., :-1]}
+    encoder_inputs = tuple(samples[name] for name in encoder.input_names)
+    with torch.no_grad():
+        zs = encoder(*encoder_inputs)
+        state = memory_encoder(*zs)
+        # The decoding step is traced with a non empty self-attention cache, as in most of its calls, and with several
+        # new tokens, so that the graph keeps the causal mask between them
+        state = decoder_step(example_text[..., :1], *state)[1:]
+    x_new = example_text[..., 1:3]
+    state_names = ['state{}'.format(i) for i in range(len(state))]
+    new_state_names = ['new_state{}'.format(i) for i in range(len(state))]
+    # The state holds the self-attention keys and values followed by the cross-attention ones for each layer
+    state_axes = [{0: 'batch', 2: 'past_len'} if i % 4 < 2 else {0: 'batch'} for i in range(len(state))]
+    # The updated self-attention caches hold past_len + n_new positions
+    new_state_axes = [{0: 'batch', 2: 'new_len'} if i % 4 < 2 else {0: 'batch'} for i in range(len(state))]
+
+    exports = [('encoder', encoder, encoder_inputs, list(encoder.input_names), encoder.z_names,
+                {**{name: {0: 'batch', 1: 'len'} for name in encoder.input_names},
+                 **{name: {0: 'batch'} for name in encoder.z_names}}),
+               ('memory_encoder', memory_encoder, zs, memory_encoder.z_names, state_names,
+                {**{name: {0: 'batch'} for name in memory_encoder.z_names},
+                 **{name: {0: 'batch'} for name in state_names}}),
+               ('decoder_step', decoder_step, (x_new, *state), ['x_new'] + state_names,
+                ['logits'] + new_state_names,
+                {'x_new': {0: 'batch', 1: 'n_new'}, 'logits': {0: 'batch'},
+                 **dict(zip(state_names, state_axes)), **dict(zip(new_state_names, new_state_axes))})]
+    for name, module, inputs, input_names, output_names, dynamic_axes in exports:
+        with torch.no_grad():
+            if 'torchscript' in formats:
+                torch.jit.trace(module, inputs, check_trace=False).save('{}_{}.pt'.format(path, name))
+            if 'onnx' in formats:
+                torch.onnx.export(module, inputs, '{}_{}.onnx'.format(path, name), input_names=input_names,
+                                  output_names=output_names, dynamic_axes=dynamic_axes, opset_version=opset_version)
+
+    with open('{}_vocab.txt'.format(path), 'w') as f:
+        f.write('\n'.join(model.index[model.generated_v].itos)+'\n')
+    print("Exported {} to {}".format(model.h_params.test_name, os.path.dirname(path) or '.'))
@@ -56,7 +56,11 @@ class DefaultHParams:
                  word_dropout=0.0,
                  contiguous_lm=False,
                  n_latents=1,
-                 minimal_enc=False):
+                 minimal_enc=False,
+                 sampled_softmax=0,
+                 log_every=1,
+                 iw_chunk_size=None,
+                 vocab_chunk_size=None):
         # A name to be used for checkpoints and Tensorboard logging indexation
         self.test_name = test_name
         self.save_path = os.path.join(ROOT_CHECKPOINTING_PATH, test_name+'.pth')
@@ -107,6 +111,11 @@ class DefaultHParams:
         self.is_weighted = is_weighted or []
         self.piwo = piwo
         self.ipiwo = ipiwo
+        # Number of negative samples for SampledSoftmaxELBo
+        self.sampled_softmax = sampled_softmax
+        # Vocabulary chunk size of the fused output projection and cross-entropy of the criteria (which are computed
+        # separately, from the full logits, if None)
+        self.vocab_chunk_size = vocab_chunk_size
 
         # Optimization hyper-parameters
         self.optimizer = optimizer
@@ -115,6 +124,8 @@ class DefaultHParams:
         self.anneal_kl = anneal_kl
         self.anneal_kl_type = anneal_kl_type
         self.grad_clip = grad_clip
+        # Number of training steps between two dumps of the training metrics
+        self.log_every = log_every
         self.kl_th = kl_th
         self.kl_beta = kl_beta
         self.max_elbo = max_elbo
@@ -125,6 +136,8 @@ class DefaultHParams:
         self.training_iw_samples = training_iw_samples
         self.testing_iw_samples = testing_iw_samples
         self.test_prior_samples = test_prior_samples
+        # Number of importance samples for which IWLBo computes the reconstruction term at once (all of them if None)
+        self.iw_chunk_size = iw_chunk_size
 
         # This constructing will mainly serve as a sanity-check for the hyper parameter setting
         assert len(self.losses) == len(self.loss_params)
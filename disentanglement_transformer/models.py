@@ -1,3 +1,5 @@
+from contextlib import contextmanager
+
 from torch.utils.tensorboard import SummaryWriter
 import torch
 from torch.optim import SGD
@@ -7,10 +9,10 @@ import pandas as pd
 
 from disentanglement_transformer.h_params import *
 from disentanglement_transformer.graphs import get_vanilla_graph
-from components.links import CoattentiveTransformerLink, ConditionalCoattentiveTransformerLink
 from components.bayesnets import BayesNet
 from components.criteria import Supervision
-from components.latent_variables import MultiCategorical
+from components.latent_variables import Categorical, MultiCategorical
+from components.compilation import CompiledCallable, compilation_report
 import spacy
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import roc_auc_score
@@ -51,9 +53,15 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
         self.gen_bn = BayesNet(vertices['gen'])
         self.gen_last_states = None
         self.gen_last_states_test = None
+        # Word embeddings of the current step's token tensors, shared by the variables using them (see _embed_text)
+        self.token_embeddings = {}
+        for v in self.infer_bn.variables | self.gen_bn.variables:
+            if isinstance(v, Categorical) and v.embedding is self.word_embeddings:
+                v.embedding_cache = self.token_embeddings
 
         # Setting up categorical variable indexes
         self.index = {self.generated_v: vocab_index}
+        self.eos_mask = None
 
         # The losses
         self.losses = [loss(self, w) for loss, w in zip(h_params.losses, h_params.loss_params)]
@@ -68,6 +76,8 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
         # Getting the Summary writer
         self.writer = SummaryWriter(h_params.viz_path)
         self.step = 0
+        self.quantized = False
+        self.compiled = []
 
         # Loading previous checkpoint if auto_load is set to True
         if autoload:
@@ -79,6 +89,7 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
             self.optimizer.zero_grad()
         #                          ----------- Unsupervised Forward/Backward ----------------
         # Forward pass
+        self._embed_text(samples)
         infer_inputs = {'x': samples['x'],  'x_prev': samples['x_prev']}
         alter = np.random.choice(['skip', 'crop'])
         if alter == 'skip':
@@ -108,6 +119,7 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
 
         # Loss computation and backward pass
         losses_uns = [loss.get_loss() * loss.w for loss in self.losses if not isinstance(loss, Supervision)]
+        self.token_embeddings.clear()
         sum(losses_uns).backward()
         if not self.h_params.contiguous_lm:
             self.infer_last_states, self.gen_last_states = None, None
@@ -132,6 +144,7 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
 
         #                          ----------- Unsupervised Forward ----------------
         # Forward pass
+        self._embed_text(samples)
         infer_inputs = {'x': samples['x'],  'x_prev': samples['x_prev']}
 
         infer_prev = self.infer_bn(infer_inputs, n_iw=self.h_params.testing_iw_samples, eval=eval,
@@ -148,13 +161,30 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
 
         # Loss computation
         [loss.get_loss() * loss.w for loss in self.losses if not isinstance(loss, Supervision)]
+        self.token_embeddings.clear()
 
         if self.h_params.contiguous_lm:
             return infer_prev, gen_prev
         else:
             return None, None
 
+    def _embed_text(self, samples):
+        # When samples holds the token tensor 'text' of which x and x_prev are the [..., 1:] and [..., :-1] slices, it
+        # is embedded once, and the variables embedding x or x_prev get views of its embeddings through
+        # token_embeddings until it is cleared at the end of the step. Word dropout is still applied by each variable.
+        self.token_embeddings.clear()
+        text = samples.get('text')
+        if text is None:
+            return
+        assert samples['x'].shape[-1] == samples['x_prev'].shape[-1] == text.shape[-1] - 1
+        embedded = self.word_embeddings(text)
+        self.token_embeddings[id(samples['x'])] = (samples['x'], embedded[..., 1:, :])
+        self.token_embeddings[id(samples['x_prev'])] = (samples['x_prev'], embedded[..., :-1, :])
+
     def _dump_train_viz(self):
+        # Training metrics are only computed for the steps where they are logged
+        if self.step % self.h_params.log_every:
+            return
         # Dumping gradient norm
         if (self.step % self.h_params.grad_accumulation_steps) == (self.h_params.grad_accumulation_steps - 1):
             z_gen = [var for var in self.gen_bn.variables if var.name == 'z1'][0]
@@ -264,22 +294,145 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
 
             else:
                 # Normal Autoregressive generation
-                for i in range(gen_len):
-                    self.gen_bn({'x_prev': x_prev, **{k: v.expand(v.shape[0], i+1, v.shape[-1])
-                                                      for k, v in z_input.items()}})
-                    if only_z_sampling:
-                        samples_i = self.generated_v.post_params['logits']
-                    else:
-                        samples_i = self.generated_v.posterior(logits=self.generated_v.post_params['logits'],
-                                                               temperature=temp).rsample()
-                    x_prev = torch.cat([x_prev, torch.argmax(samples_i,     dim=-1)[..., -1].unsqueeze(-1)],
-                                       dim=-1)
+                x_prev = self._autoregressive_generation(z_input, x_prev, gen_len,
+                                                         strategy='greedy' if only_z_sampling else 'sample',
+                                                         temperature=temp)
 
             summary_triplets.append(
                 ('text', '/prior_sample', self.decode_to_text(x_prev, gen=True)))
 
         return summary_triplets
 
+    def generate(self, z_input=None, n_samples=None, gen_len=None, strategy='greedy', temperature=1., top_k=0,
+                 top_p=1., beam_size=4, complete=None):
+        # Decodes sentences from the latent values in z_input ({'z1': [n, z_size], ...}) or, if it isn't given, from
+        # n_samples draws of the prior. strategy is either 'greedy', 'sample' (with a temperature, and optional top-k
+        # and nucleus filtering) or 'beam' (batched beam search keeping beam_size hypotheses per sentence).
+        # Returns the generated texts along with the latent values they were decoded from.
+        assert strategy in ('greedy', 'sample', 'beam'), "Unknown decoding strategy {}".format(strategy)
+        with torch.no_grad():
+            if z_input is None:
+                z_sample = self.gen_bn.name_to_v['z1'].prior_sample((n_samples,))[0]
+                child_zs = [self.gen_bn.name_to_v['z{}'.format(i)] for i in range(2, len(self.h_params.n_latents) + 1)]
+                self.gen_bn({'z1': z_sample.unsqueeze(1),
+                             'x_prev': torch.zeros((n_samples, 1, self.generated_v.size)).to(self.h_params.device)})
+                z_input = {'z1': z_sample, **{z.name: z.post_samples.squeeze(1) for z in child_zs}}
+            n_samples = z_input['z1'].shape[0]
+            gen_len = gen_len or self.h_params.max_len
+            stoi = self.index[self.generated_v].stoi
+            prefix = [stoi['<go>']]
+            if complete is not None:
+                prefix += [stoi[token] for token in complete.split(' ')]
+                gen_len = gen_len - len(complete.split(' '))
+            x_prev = torch.tensor(prefix, device=self.h_params.device).unsqueeze(0).expand(n_samples, len(prefix))
+
+            z_seq_input = {k: v.unsqueeze(1) for k, v in z_input.items()}
+            if strategy == 'beam':
+                x_prev = self._beam_search(z_seq_input, x_prev, gen_len, beam_size, temperature=temperature)
+            else:
+                x_prev = self._autoregressive_generation(z_seq_input, x_prev, gen_len, strategy=strategy,
+                                                         temperature=temperature, top_k=top_k, top_p=top_p)
+            text = self.decode_to_text2(x_prev, self.h_params.vocab_size, self.index[self.generated_v])
+        return text, z_input
+
+    def _generation_step(self, z_input, x_prev, x_new, gen_states):
+        # Runs the generation network for a decoding step, and returns the next token logits of each row along with the
+        # updated states. If the decoder link supports it, only the new tokens x_new are fed and the link's cached
+        # attention states are carried from a step to the next through the generation network states. Otherwise, the
+        # whole prefixes x_prev are decoded again.
+        if self.gen_bn.approximator[self.generated_v].supports_incremental:
+            gen_states = self.gen_bn({'x_prev': x_new, **{k: v.expand(v.shape[0], x_new.shape[-1], v.shape[-1])
+                                                          for k, v in z_input.items()}},
+                                     target=self.generated_v, prev_states=gen_states, incremental=True)
+        else:
+            self.gen_bn({'x_prev': x_prev, **{k: v.expand(v.shape[0], x_prev.shape[-1], v.shape[-1])
+                                              for k, v in z_input.items()}}, target=self.generated_v)
+        return self.generated_v.post_params['logits'][..., -1, :], gen_states
+
+    def _autoregressive_generation(self, z_input, x_prev, gen_len, strategy='greedy', temperature=1., top_k=0,
+                                   top_p=1.):
+        # Extends the x_prev prefixes with up to gen_len tokens, either picked greedily or sampled.
+        # Rows are dropped from the decoded batch as soon as they contain a token at which decode_to_text(2) cuts the
+        # sentence, and generation stops when all rows are finished. The remaining positions of finished rows are
+        # padded, which leaves the decoded text unchanged.
+        assert strategy in ('greedy', 'sample'), "Unknown decoding strategy {}".format(strategy)
+        eos_mask = self._get_eos_mask()
+        x_out = torch.full((x_prev.shape[0], x_prev.shape[-1] + gen_len), self.h_params.vocab_ignore_index,
+                           dtype=x_prev.dtype, device=x_prev.device)
+        x_out[:, :x_prev.shape[-1]] = x_prev
+        out_len = x_prev.shape[-1]
+
+        # Indices of the rows that are still being generated
+        active = torch.nonzero(~eos_mask[x_prev].any(-1)).squeeze(-1)
+        x_prev, z_input = x_prev[active], {k: v[active] for k, v in z_input.items()}
+        gen_states, x_new = None, x_prev
+        for i in range(gen_len):
+            if active.shape[0] == 0:
+                break
+            logits, gen_states = self._generation_step(z_input, x_prev, x_new, gen_states)
+            if strategy == 'greedy':
+                x_new = torch.argmax(logits, dim=-1).unsqueeze(-1)
+            else:
+                logits = top_k_top_p_filtering(logits / temperature, top_k=top_k, top_p=top_p)
+                x_new = torch.multinomial(torch.softmax(logits, dim=-1), 1)
+            x_prev = torch.cat([x_prev, x_new], dim=-1)
+            x_out[active, out_len] = x_new[:, 0]
+            out_len += 1
+
+            # Dropping finished rows
+            unfinished = ~eos_mask[x_new[:, 0]]
+            if not unfinished.all():
+                keep = torch.nonzero(unfinished).squeeze(-1)
+                active, x_prev, x_new = active[keep], x_prev[keep], x_new[keep]
+                z_input = {k: v[keep] for k, v in z_input.items()}
+                if gen_states is not None:
+                    gen_states = self.gen_bn.reorder_states(gen_states, keep)
+
+        return x_out[:, :out_len]
+
+    def _beam_search(self, z_input, x_prev, gen_len, beam_size, temperature=1.):
+        # Batched beam search: the beam_size hypotheses of all the rows are decoded together as a single batch of
+        # n_rows*beam_size sequences. Finished hypotheses are frozen (only extended with padding, at no cost) until all
+        # hypotheses are finished. Returns the highest scoring hypothesis of each row.
+        n_rows, device = x_prev.shape[0], x_prev.device
+        eos_mask = self._get_eos_mask()
+        x_prev = x_prev.repeat_interleave(beam_size, dim=0)
+        z_input = {k: v.repeat_interleave(beam_size, dim=0) for k, v in z_input.items()}
+        finished = eos_mask[x_prev].any(-1)
+        # Only the first hypothesis of each row is alive at the start, so that the beams don't start as duplicates
+        scores = torch.full((n_rows, beam_size), float('-inf'), device=device)
+        scores[:, 0] = 0.
+        row_offsets = (torch.arange(n_rows, device=device) * beam_size).unsqueeze(-1)
+        pad_log_probs = None
+        gen_states, x_new = None, x_prev
+        for i in range(gen_len):
+            if finished.all():
+                break
+            logits, gen_states = self._generation_step(z_input, x_prev, x_new, gen_states)
+            vocab_size = logits.shape[-1]
+            if pad_log_probs is None:
+                pad_log_probs = torch.full((vocab_size,), float('-inf'), device=device)
+                pad_log_probs[self.h_params.vocab_ignore_index] = 0.
+            log_probs = torch.where(finished.unsqueeze(-1), pad_log_probs, torch.log_softmax(logits / temperature, -1))
+            candidates = (scores.view(-1, 1) + log_probs).view(n_rows, beam_size * vocab_size)
+            scores, top_idx = candidates.topk(beam_size, dim=-1)
+            # Hypotheses each new one extends
+            origin = (row_offsets + torch.div(top_idx, vocab_size, rounding_mode='floor')).view(-1)
+            x_new = (top_idx % vocab_size).view(-1, 1)
+            x_prev = torch.cat([x_prev[origin], x_new], dim=-1)
+            finished = finished[origin] | eos_mask[x_new[:, 0]]
+            if gen_states is not None:
+                gen_states = self.gen_bn.reorder_states(gen_states, origin)
+
+        return x_prev[scores.argmax(-1) + row_offsets[:, 0]]
+
+    def _get_eos_mask(self):
+        # Boolean mask over the vocabulary of the tokens at which the decoded text of a sentence is cut
+        if self.eos_mask is None:
+            self.eos_mask = torch.tensor([any(eos in w for eos in ('<eos>', '.', '!', '?'))
+                                          for w in self.index[self.generated_v].itos], device=self.h_params.device)
+        return self.eos_mask
+
     def decode_to_text(self, x_hat_params, gen=False):
         # It is assumed that this function is used at test time for display purposes
         # Getting the argmax from the one hot if it's not done
@@ -332,8 +485,19 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
 
         return samples
 
+    @contextmanager
+    def scoring_hidden_states(self):
+        # With the fused output projection, the generation link outputs its hidden states in evaluation too within this
+        # context, for the criteria to score them without building the logits
+        link = self.gen_bn.approximator[self.generated_v]
+        link.eval_hidden_output = bool(self.h_params.vocab_chunk_size)
+        try:
+            yield
+        finally:
+            link.eval_hidden_output = False
+
     def get_perplexity(self, iterator):
-        with torch.no_grad():
+        with torch.no_grad(), self.scoring_hidden_states():
             neg_log_perplexity_lb = 0
             total_samples = 0
             infer_prev, gen_prev = None, None
@@ -342,8 +506,8 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
 
             for i, batch in enumerate(tqdm(iterator, desc="Getting Model Perplexity")):
                 if batch.text.shape[1] < 2: continue
-                infer_prev, gen_prev = self({'x': batch.text[..., 1:],
-                                             'x_prev': batch.text[..., :-1]}, prev_states=(infer_prev, gen_prev),
+                infer_prev, gen_prev = self({'x': batch.text[..., 1:], 'x_prev': batch.text[..., :-1],
+                                             'text': batch.text}, prev_states=(infer_prev, gen_prev),
                                             force_iw=force_iw,
                                             )
                 if not self.h_params.contiguous_lm:
@@ -362,6 +526,7 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
             return perplexity_ub.cpu().detach().item()
 
     def save(self):
+        assert not self.quantized, "Quantized models are for inference only, save the fp32 model instead"
         root = ''
         for subfolder in self.h_params.save_path.split(os.sep)[:-1]:
             root = os.path.join(root, subfolder)
@@ -372,13 +537,51 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
 
     def load(self):
         if os.path.exists(self.h_params.save_path):
-            checkpoint = torch.load(self.h_params.save_path)
+            checkpoint = torch.load(self.h_params.save_path, map_location=self.h_params.device)
             model_checkpoint, self.step = checkpoint['model_checkpoint'], checkpoint['step']
             self.load_state_dict(model_checkpoint)
             print("Loaded model at step", self.step)
         else:
             print("Save file doesn't exist, the model will be trained from scratch.")
 
+    def quantize(self):
+        # Switches the model to int8 CPU inference: the linear layers of all links are dynamically quantized (int8
+        # weights, activations quantized on the fly), and the output projections on the tied embeddings use an int8 copy
+        # of the embedding matrix. This can't be undone, and the quantized model can't be trained nor saved.
+        assert self.h_params.device.type == 'cpu', "Quantized inference is only supported on CPU"
+        self.eval()
+        for bn in (self.infer_bn, self.gen_bn):
+            torch.quantization.quantize_dynamic(bn, {nn.Linear}, dtype=torch.qint8, inplace=True)
+            for link in bn.approximator.values():
+                if link.embedding is not None and getattr(link, 'sbn', None) is None:
+                    link.quantize_embedding_projection()
+        self.quantized = True
+
+    def compile_networks(self, backend='inductor'):
+        # Compiles the forward pass of each link of the inference and generation networks, and the reconstruction term
+        # of the losses. The BayesNets' dict-driven control flow stays in Python, between the compiled parts, and the
+        # parts that fail to compile are run eagerly (see CompiledCallable).
+        assert not self.quantized, "Quantized models can't be compiled"
+        for bn_name, bn in [('infer', self.infer_bn), ('gen', self.gen_bn)]:
+            for lv, link in bn.approximator.items():
+                if isinstance(link.forward, CompiledCallable):
+                    continue
+                link.forward = CompiledCallable(link.forward, '{}/{}'.format(bn_name, lv.name), backend=backend)
+                self.compiled.append(link.forward)
+        for loss in self.losses:
+            # Reconstruction terms of the ELBo-like criteria, of the importance weighted bound, and of Reconstruction
+            for fn_name in ['_get_log_p_xIz', '_iw_log_likelihood', '_get_log_p_x']:
+                fn = getattr(loss, fn_name, None)
+                if fn is None or isinstance(fn, CompiledCallable):
+                    continue
+                setattr(loss, fn_name, CompiledCallable(fn, '{}.{}'.format(type(loss).__name__, fn_name),
+                                                        backend=backend))
+                self.compiled.append(getattr(loss, fn_name))
+
+    def compilation_report(self):
+        # Prints the compilation status of each compiled component and returns the total compilation time
+        return compilation_report(self.compiled)
+
     def reduce_lr(self, factor):
         for param_group in self.optimizer.param_groups:
             param_group['lr'] /= factor
@@ -406,29 +609,45 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
                 v.switch_to_relaxed()
         super(DisentanglementTransformerVAE, self).train(mode=mode)
 
+    def encode(self, text, mode='mean', slots=False):
+        # Runs only the inference network on a batch of <go> ... <eos> token sequences, and returns the posterior
+        # means (mode='mean') or samples (mode='sample') of the latent variables as {'z1': [batch, z1_size], ...}.
+        # With slots=True, the list of the vectors of each latent index is returned instead.
+        assert mode in ('mean', 'sample'), "Unknown encoding mode {}".format(mode)
+        with torch.no_grad():
+            samples = {'x': text[..., 1:], 'x_prev': text[..., :-1], 'text': text}
+            self._embed_text(samples)
+            self.infer_bn({'x': samples['x'], 'x_prev': samples['x_prev']}, eval=mode == 'mean')
+            self.token_embeddings.clear()
+            z_vals = {}
+            for j in range(len(self.h_params.n_latents)):
+                zj = self.infer_bn.name_to_v['z{}'.format(j+1)]
+                assert isinstance(zj, Gaussian), "Only Gaussian latent variables can be encoded"
+                z_vals[zj.name] = (zj.post_params['loc'] if mode == 'mean' else zj.post_samples)[..., 0, :]
+        if not slots:
+            return z_vals
+        z_slots = []
+        for j, size in enumerate(self.h_params.n_latents):
+            zj_val = z_vals['z{}'.format(j+1)]
+            emb_size = int(zj_val.shape[-1]/size)
+            z_slots.extend([zj_val[..., k*emb_size:(k+1)*emb_size] for k in range(size)])
+        return z_slots
+
+    def encode_iterator(self, iterator, mode='mean', slots=False):
+        # Streams the encodings of the batches of a data iterator, along with the batches themselves
+        for batch in iterator:
+            if batch.text.shape[1] < 2: continue
+            yield self.encode(batch.text, mode=mode, slots=slots), batch
+
     def get_sentiment_summaries(self, iterator):
         with torch.no_grad():
-            infer_prev, gen_prev = None, None
             z_vals = [[] for _ in range(sum(self.h_params.n_latents))]
             y_vals = []
-            for i, batch in enumerate(tqdm(iterator, desc="Getting Model Sentiment stats")):
-                if batch.text.shape[1] < 2: continue
-                infer_prev, gen_prev = self({'x': batch.text[..., 1:],
-                                             'x_prev': batch.text[..., :-1]}, prev_states=(infer_prev, gen_prev),
-                                            )
+            for z_vals_i, batch in tqdm(self.encode_iterator(iterator, mode='sample', slots=True),
+                                        desc="Getting Model Sentiment stats"):
                 y_vals.extend(batch.label[:, 0].cpu().numpy())
-                # Getting z values
-                z_vals_i = []
-                for j, size in enumerate(self.h_params.n_latents):
-                    zj_val = self.infer_bn.name_to_v['z{}'.format(j+1)].post_samples
-                    for k in range(size):
-                        emb_size = int(zj_val.shape[-1]/size)
-                        z_vals_i.append(zj_val[..., 0, k*emb_size:(k+1)*emb_size].cpu().numpy())
                 for l in range(len(z_vals_i)):
-                    z_vals[l].extend(z_vals_i[l])
-
-                if not self.h_params.contiguous_lm:
-                    infer_prev, gen_prev = None, None
+                    z_vals[l].extend(z_vals_i[l].cpu().numpy())
             print("Collected {} z samples for each of the zs, and {} labels".format([len(v) for v in z_vals], len(y_vals)))
             fold_size = int([len(v) for v in z_vals][0]/2)
             classifier = LogisticRegression()
@@ -529,28 +748,64 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
                     [z.post_samples.squeeze(1) for z in zs[1:]]
 
         for id in var_z_ids:
-            assert id < sum(h_params.n_latents)
-            z_number = sum([id > sum(h_params.n_latents[:i + 1]) for i in range(len(h_params.n_latents))])
-            z_index = id - sum(h_params.n_latents[:z_number])
-            start, end = int(h_params.z_size / max(h_params.n_latents) * z_index), int(
-                h_params.z_size / max(h_params.n_latents) * (z_index + 1))
+            z_number, start, end = self._latent_id_to_slice(id)
             source, destination = zs_sample[z_number], orig_zs[z_number]
             destination[:, start:end] = source[:, start:end]
 
         z_input = {'z{}'.format(i+1): orig_zs[i].unsqueeze(1) for i in range(len(orig_zs))}
 
         # Normal Autoregressive generation
-        for i in range(gen_len):
-            self.gen_bn({'x_prev': x_prev, **{k: v.expand(v.shape[0], i + 1, v.shape[-1])
-                                             for k, v in z_input.items()}})
-            samples_i = self.generated_v.post_params['logits']
-
-            x_prev = torch.cat([x_prev, torch.argmax(samples_i, dim=-1)[..., -1].unsqueeze(-1)],
-                               dim=-1)
+        x_prev = self._autoregressive_generation(z_input, x_prev, gen_len)
 
         text = self.decode_to_text2(x_prev, self.h_params.vocab_size, self.index[self.generated_v])
         return text, {'z{}'.format(i+1): zs_sample[i].tolist() for i in range(len(orig_zs))}
 
+    def _get_all_alternative_sentences(self, prev_latent_vals, n_samples, gen_len, complete=None):
+        # Same as calling _get_alternative_sentences with var_z_ids=[j] for each latent index j, but all the
+        # alterations are decoded together as a single batch of sum(n_latents) * n_samples * n_orig_sentences rows.
+        # Returns the list of altered texts for each latent index.
+        h_params = self.h_params
+        n_ids = sum(h_params.n_latents)
+        n_rows = n_samples * prev_latent_vals['z1'].shape[0]
+        stoi = self.index[self.generated_v].stoi
+        prefix = [stoi['<go>']]
+        if complete is not None:
+            prefix += [stoi[token] for token in complete.split(' ')]
+            gen_len = gen_len - len(complete.split(' '))
+        x_prev = torch.tensor(prefix, device=h_params.device).unsqueeze(0).expand(n_ids * n_rows, len(prefix))
+
+        # Rows are ordered by latent index, then by alteration, then by original sentence
+        orig_zs = [prev_latent_vals['z{}'.format(i+1)].repeat(n_ids * n_samples, 1)
+                   for i in range(len(h_params.n_latents))]
+        zs = [self.gen_bn.name_to_v['z{}'.format(i+1)] for i in range(len(h_params.n_latents))]
+        self.gen_bn({**{'z{}'.format(i+1): orig_zs[i].unsqueeze(1) for i in range(len(orig_zs))},
+                     'x_prev': torch.zeros((n_ids * n_rows, 1, self.generated_v.size)).to(h_params.device)})
+        zs_sample = [zs[0].prior_sample((n_ids * n_rows,))[0]] + [z.post_samples.squeeze(1) for z in zs[1:]]
+
+        # Swapping, for each latent index, its slice of the latent vector in its own block of rows
+        swap_masks = [torch.zeros((n_ids, 1, z.shape[-1]), dtype=torch.bool, device=h_params.device) for z in orig_zs]
+        for id in range(n_ids):
+            z_number, start, end = self._latent_id_to_slice(id)
+            swap_masks[z_number][id, :, start:end] = True
+        z_input = {'z{}'.format(i+1): torch.where(swap_masks[i], zs_sample[i].view(n_ids, n_rows, -1),
+                                                  orig_zs[i].view(n_ids, n_rows, -1)).view(n_ids * n_rows, 1, -1)
+                   for i in range(len(orig_zs))}
+
+        x_prev = self._autoregressive_generation(z_input, x_prev, gen_len)
+        text = self.decode_to_text2(x_prev, h_params.vocab_size, self.index[self.generated_v])
+        return [text[id * n_rows:(id + 1) * n_rows] for id in range(n_ids)]
+
+    def _latent_id_to_slice(self, id):
+        # Returns the latent variable number, and the start and end of the slice of its vector that corresponds to the
+        # latent index id
+        h_params = self.h_params
+        assert id < sum(h_params.n_latents)
+        z_number = sum([id > sum(h_params.n_latents[:i + 1]) for i in range(len(h_params.n_latents))])
+        z_index = id - sum(h_params.n_latents[:z_number])
+        start, end = int(h_params.z_size / max(h_params.n_latents) * z_index), int(
+            h_params.z_size / max(h_params.n_latents) * (z_index + 1))
+        return z_number, start, end
+
     def get_sentences(self, n_samples, gen_len=16, sample_w=False, vary_z=True, complete=None, contains=None,
                       max_tries=100):
         n_latents = self.h_params.n_latents
@@ -592,16 +847,8 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
 
             z_input = {'z{}'.format(i+1): z_s.unsqueeze(1) for i, z_s in enumerate(zs_samples)}
             # Normal Autoregressive generation
-            for i in range(gen_len):
-                self.gen_bn({'x_prev': x_prev, **{k: v.expand(v.shape[0], i + 1, v.shape[-1])
-                                                 for k, v in z_input.items()}})
-                if not sample_w:
-                    samples_i = self.generated_v.post_params['logits']
-                else:
-                    samples_i = self.generated_v.posterior(logits=self.generated_v.post_params['logits'] / temp,
-                                                          temperature=1).rsample()
-                x_prev = torch.cat([x_prev, torch.argmax(samples_i, dim=-1)[..., -1].unsqueeze(-1)],
-                                   dim=-1)
+            x_prev = self._autoregressive_generation(z_input, x_prev, gen_len,
+                                                     strategy='sample' if sample_w else 'greedy', temperature=temp)
 
             text = self.decode_to_text2(x_prev, self.h_params.vocab_size, self.index[self.generated_v])
             if contains is None:
@@ -667,9 +914,8 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
         rel_idx = [out['idx'] for out in shallow_dependencies(text_sents)]
         # Getting layer wise attention values
 
-        CoattentiveTransformerLink.get_att, ConditionalCoattentiveTransformerLink.get_att = True, True
-        self.infer_bn({'x': text_in})
-        CoattentiveTransformerLink.get_att, ConditionalCoattentiveTransformerLink.get_att = False, False
+        with self.infer_bn.recording_attention():
+            self.infer_bn({'x': text_in})
         all_att_weights = []
         for i in range(len(self.h_params.n_latents)):
             trans_mod = self.infer_bn.approximator[self.infer_bn.name_to_v['z{}'.format(i + 1)]]
@@ -703,9 +949,8 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
         rel_idx = [out['idx'] for out in shallow_dependencies2(text_sents, roles)]
         # Getting layer wise attention values
 
-        CoattentiveTransformerLink.get_att, ConditionalCoattentiveTransformerLink.get_att = True, True
-        self.infer_bn({'x': text_in})
-        CoattentiveTransformerLink.get_att, ConditionalCoattentiveTransformerLink.get_att = False, False
+        with self.infer_bn.recording_attention():
+            self.infer_bn({'x': text_in})
         all_att_weights = []
         for i in range(len(self.h_params.n_latents)):
             trans_mod = self.infer_bn.approximator[self.infer_bn.name_to_v['z{}'.format(i + 1)]]
@@ -837,16 +1082,16 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
                 samples[k] = torch.cat([samples[k], samples_i[k]])
             orig_rels.extend(shallow_dependencies(text_i))
             orig_temps.extend(truncated_template(text_i))
-        for i in range(int(n_samples / batch_size)):
-            for j in tqdm(range(sum(self.h_params.n_latents)), desc="Processing sample {}".format(str(i))):
-                # Altering the sentences
-                alt_text, _ = self._get_alternative_sentences(
-                    prev_latent_vals={k: v[i * batch_size:(i + 1) * batch_size]
-                                      for k, v in samples.items()},
-                    params=None, var_z_ids=[j], n_samples=n_alterations,
-                    gen_len=self.h_params.max_len - 1, complete=None)
-                alt_rels = shallow_dependencies(alt_text)
-                alt_temps = truncated_template(alt_text)
+        n_alt = n_alterations * batch_size
+        for i in tqdm(range(int(n_samples / batch_size)), desc="Processing samples"):
+            # Altering the sentences for all the latent indices at once
+            all_alt_text = self._get_all_alternative_sentences(
+                prev_latent_vals={k: v[i * batch_size:(i + 1) * batch_size] for k, v in samples.items()},
+                n_samples=n_alterations, gen_len=self.h_params.max_len - 1, complete=None)
+            all_alt_rels = shallow_dependencies(list(itertools.chain.from_iterable(all_alt_text)))
+            all_alt_temps = truncated_template(list(itertools.chain.from_iterable(all_alt_text)))
+            for j, alt_text in enumerate(all_alt_text):
+                alt_rels, alt_temps = all_alt_rels[j * n_alt:(j + 1) * n_alt], all_alt_temps[j * n_alt:(j + 1) * n_alt]
                 # Getting alteration statistics
                 for k in range(n_alterations * batch_size):
                     orig_text = text[(i * batch_size) + k % batch_size]
@@ -916,16 +1161,16 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
                 samples[k] = torch.cat([samples[k], samples_i[k]])
             orig_rels.extend(shallow_dependencies2(text_i, roles))
             orig_temps.extend(truncated_template(text_i))
-        for i in range(int(n_samples / batch_size)):
-            for j in tqdm(range(sum(self.h_params.n_latents)), desc="Processing sample {}".format(str(i))):
-                # Altering the sentences
-                alt_text, _ = self._get_alternative_sentences(
-                    prev_latent_vals={k: v[i * batch_size:(i + 1) * batch_size]
-                                      for k, v in samples.items()},
-                    params=None, var_z_ids=[j], n_samples=n_alterations,
-                    gen_len=self.h_params.max_len - 1, complete=None)
-                alt_rels = shallow_dependencies2(alt_text, roles)
-                alt_temps = truncated_template(alt_text)
+        n_alt = n_alterations * batch_size
+        for i in tqdm(range(int(n_samples / batch_size)), desc="Processing samples"):
+            # Altering the sentences for all the latent indices at once
+            all_alt_text = self._get_all_alternative_sentences(
+                prev_latent_vals={k: v[i * batch_size:(i + 1) * batch_size] for k, v in samples.items()},
+                n_samples=n_alterations, gen_len=self.h_params.max_len - 1, complete=None)
+            all_alt_rels = shallow_dependencies2(list(itertools.chain.from_iterable(all_alt_text)), roles)
+            all_alt_temps = truncated_template(list(itertools.chain.from_iterable(all_alt_text)))
+            for j, alt_text in enumerate(all_alt_text):
+                alt_rels, alt_temps = all_alt_rels[j * n_alt:(j + 1) * n_alt], all_alt_temps[j * n_alt:(j + 1) * n_alt]
                 # Getting alteration statistics
                 for k in range(n_alterations * batch_size):
                     orig_text = text[(i * batch_size) + k % batch_size]
@@ -1001,52 +1246,57 @@ class DisentanglementTransformerVAE(nn.Module, metaclass=abc.ABCMeta):
             self.writer.add_scalar('test/decoder_Ndisent_vars', decoder_Ndisent_vars, self.step)
         return dec_lab_wise_disent, enc_lab_wise_disent, decoder_Ndisent_vars, encoder_Ndisent_vars
 
-    def get_disentanglement_summaries2(self, data_iter, n_samples=2000):
+    def get_disentanglement_summaries2(self, data_iter, n_samples=2000, log=True):
+        # log=False only returns the scores, without writing them to the model's summaries
         with torch.no_grad():
             if self.h_params.graph_generator != get_vanilla_graph:
                 enc_var_wise_scores, enc_max_score, enc_lab_wise_disent, enc_disent_vars = \
                     self.get_encoder_disentanglement_score(data_iter)
-                self.writer.add_scalar('test/total_enc_disent_score', sum(enc_lab_wise_disent.values()), self.step)
-                for k in enc_lab_wise_disent.keys():
-                    self.writer.add_scalar('test/enc_disent_score[{}]'.format(k), enc_lab_wise_disent[k], self.step)
-                enc_heatmap = get_hm_array2(pd.DataFrame(enc_var_wise_scores))#, "enc_heatmap_yelp.eps")
-                self.writer.add_image('test/encoder_disentanglement', enc_heatmap, self.step)
                 encoder_Ndisent_vars = len(set(enc_disent_vars.values()))
-                self.writer.add_scalar('test/encoder_Ndisent_vars', encoder_Ndisent_vars, self.step)
+                if log:
+                    self.writer.add_scalar('test/total_enc_disent_score', sum(enc_lab_wise_disent.values()), self.step)
+                    for k in enc_lab_wise_disent.keys():
+                        self.writer.add_scalar('test/enc_disent_score[{}]'.format(k), enc_lab_wise_disent[k], self.step)
+                    enc_heatmap = get_hm_array2(pd.DataFrame(enc_var_wise_scores))#, "enc_heatmap_yelp.eps")
+                    self.writer.add_image('test/encoder_disentanglement', enc_heatmap, self.step)
+                    self.writer.add_scalar('test/encoder_Ndisent_vars', encoder_Ndisent_vars, self.step)
             else:
                 enc_lab_wise_disent, encoder_Ndisent_vars = {'subj': 0, 'verb': 0, 'dobj': 0, 'pobj': 0}, 0
 
             dec_disent_score, dec_lab_wise_disent, dec_var_wise_scores, dec_disent_vars\
                 = self._get_stat_data_frame2(n_samples=n_samples)
-            self.writer.add_scalar('test/total_dec_disent_score', dec_disent_score, self.step)
-            for k in dec_lab_wise_disent.keys():
-                self.writer.add_scalar('test/dec_disent_score[{}]'.format(k), dec_lab_wise_disent[k], self.step)
-            dec_heatmap = get_hm_array2(dec_var_wise_scores)#, "dec_heatmap_yelp.eps")
-            self.writer.add_image('test/decoder_disentanglement', dec_heatmap, self.step)
             decoder_Ndisent_vars = len(set(dec_disent_vars.values()))
-            self.writer.add_scalar('test/decoder_Ndisent_vars', decoder_Ndisent_vars, self.step)
+            if log:
+                self.writer.add_scalar('test/total_dec_disent_score', dec_disent_score, self.step)
+                for k in dec_lab_wise_disent.keys():
+                    self.writer.add_scalar('test/dec_disent_score[{}]'.format(k), dec_lab_wise_disent[k], self.step)
+                dec_heatmap = get_hm_array2(dec_var_wise_scores)#, "dec_heatmap_yelp.eps")
+                self.writer.add_image('test/decoder_disentanglement', dec_heatmap, self.step)
+                self.writer.add_scalar('test/decoder_Ndisent_vars', decoder_Ndisent_vars, self.step)
         return dec_lab_wise_disent, enc_lab_wise_disent, decoder_Ndisent_vars, encoder_Ndisent_vars
 
-    def collect_stats(self, data_iter):
+    def collect_stats(self, data_iter, log=True):
         kl, kl_var, rec, mi, nsamples = 0, 0, 0, 0, 0
         infer_prev, gen_prev = None, None
         loss_obj = self.losses[0]
         zs = [(self.infer_bn.name_to_v['z{}'.format(i+1)], self.gen_bn.name_to_v['z{}'.format(i+1)])
               for i in range(len(self.h_params.n_latents))]
-        with torch.no_grad():
+        with torch.no_grad(), self.scoring_hidden_states():
             for i, batch in enumerate(tqdm(data_iter, desc="Getting Model Stats")):
                 if batch.text.shape[1] < 2: continue
-                infer_prev, gen_prev = self({'x': batch.text[..., 1:],
-                                             'x_prev': batch.text[..., :-1]}, prev_states=(infer_prev, gen_prev))
+                infer_prev, gen_prev = self({'x': batch.text[..., 1:], 'x_prev': batch.text[..., :-1],
+                                             'text': batch.text}, prev_states=(infer_prev, gen_prev))
                 if not self.h_params.contiguous_lm:
                     infer_prev, gen_prev = None, None
                 nsamples += batch.text.shape[0]
+                loss_obj.metrics()
                 kl += sum([v for k, v in loss_obj.KL_dict.items() if not k.startswith('/Var')]) * batch.text.shape[0]
                 kl_var += sum([v**2 for k, v in loss_obj.KL_dict.items() if k.startswith('/Var')]) * batch.text.shape[0]
                 rec += loss_obj.log_p_xIz.sum()
                 mi += sum([z[0].get_mi(z[1]) for z in zs])
                 self.gen_bn.clear_values(), self.infer_bn.clear_values()
-        self.writer.add_scalar('test/MI', (mi/nsamples), self.step)
+        if log:
+            self.writer.add_scalar('test/MI', (mi/nsamples), self.step)
         return (kl/nsamples).cpu().detach().item(), np.sqrt(kl_var/nsamples), \
                - (rec/nsamples).cpu().detach().item(), (mi/nsamples).cpu().detach().item()
 
@@ -1099,7 +1349,7 @@ class LaggingDisentanglementTransformerVAE(DisentanglementTransformerVAE, metacl
             except StopIteration:
                 self.enc_iter = iter(self._enc_iter)
                 batch = next(self.enc_iter)
-            samples = {'x': batch.text[..., 1:], 'x_prev': batch.text[..., :-1]}
+            samples = {'x': batch.text[..., 1:], 'x_prev': batch.text[..., :-1], 'text': batch.text}
         elif mode == "decoder":
             opt_encoder, opt_decoder = False, True
         elif mode == "both":
@@ -1111,6 +1361,7 @@ class LaggingDisentanglementTransformerVAE(DisentanglementTransformerVAE, metacl
         self.gen_optimizer.zero_grad()
         #                          ----------- Unsupervised Forward/Backward ----------------
         # Forward pass
+        self._embed_text(samples)
         infer_inputs = {'x': samples['x'], 'x_prev': samples['x_prev']}
         alter = np.random.choice(['skip', 'crop'])
         if alter == 'skip':
@@ -1140,6 +1391,7 @@ class LaggingDisentanglementTransformerVAE(DisentanglementTransformerVAE, metacl
 
         # Loss computation and backward pass
         losses_uns = [loss.get_loss() * loss.w for loss in self.losses if not isinstance(loss, Supervision)]
+        self.token_embeddings.clear()
         sum(losses_uns).backward()
         if not self.h_params.contiguous_lm:
             self.infer_last_states, self.gen_last_states = None, None
@@ -1159,6 +1411,9 @@ class LaggingDisentanglementTransformerVAE(DisentanglementTransformerVAE, metacl
         return total_loss
 
     def _dump_train_viz(self):
+        # Training metrics are only computed for the steps where they are logged
+        if self.step % self.h_params.log_every:
+            return
         # Dumping gradient norm
         if (self.step % self.h_params.grad_accumulation_steps) == (self.h_params.grad_accumulation_steps - 1):
             z_gen = [var for var in self.gen_bn.variables if var.name == 'z1'][0]
@@ -1180,6 +1435,7 @@ class LaggingDisentanglementTransformerVAE(DisentanglementTransformerVAE, metacl
                 self.writer.add_scalar('train' + name, metric, self.step)
 
     def save(self):
+        assert not self.quantized, "Quantized models are for inference only, save the fp32 model instead"
         root = ''
         for subfolder in self.h_params.save_path.split(os.sep)[:-1]:
             root = os.path.join(root, subfolder)
@@ -1240,6 +1496,21 @@ def get_sentence_statistics(orig, sen, orig_relations=None, relations=None):
     return new_rels, rel_diff
 
 
+def top_k_top_p_filtering(logits, top_k=0, top_p=1.):
+    # Masks (with -inf) the logits of the tokens outside of the top_k most likely ones, and outside of the smallest set
+    # of most likely tokens whose cumulated probability exceeds top_p (nucleus sampling, Holtzman et al. 2020).
+    if top_k > 0:
+        kth_logits = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1)[0][..., -1:]
+        logits = logits.masked_fill(logits < kth_logits, float('-inf'))
+    if top_p < 1.:
+        sorted_logits, sorted_idx = torch.sort(logits, descending=True, dim=-1)
+        sorted_probs = torch.softmax(sorted_logits, dim=-1)
+        # A token is removed if the tokens that are more likely than it already exceed top_p
+        sorted_remove = (sorted_probs.cumsum(-1) - sorted_probs) > top_p
+        logits = logits.masked_fill(sorted_remove.scatter(-1, sorted_idx, sorted_remove), float('-inf'))
+    return logits
+
+
 def get_hm_array(df):
     snsplt = sns.heatmap(df, cmap='RdYlGn', linewidths=0.20, annot=False)
     b, t = plt.ylim() # discover the values for bottom and top
@@ -0,0 +1,52 @@
+# This file checks that an int8 quantized model (see DisentanglementTransformerVAE.quantize) stays close to its fp32
+# counterpart, and measures the CPU latency gains on the encode/decode workload
+from time import time
+
+import torch
+
+
+def _inference_latency(model, text, n_repeats):
+    # Mean time to encode a batch and to decode it back greedily
+    start = time()
+    for _ in range(n_repeats):
+        model.generate(z_input=model.encode(text))
+    return (time() - start) / n_repeats
+
+
+def quantization_report(fp32_model, int8_model, data, n_disentanglement_samples=200, n_latency_repeats=5,
+                        rec_tolerance=0.02, disent_tolerance=0.05):
+    # Compares the reconstruction loss and the disentanglement scores of both models on the validation set of data, as
+    # well as their latencies. The quantized model is accepted if its reconstruction loss is within rec_tolerance
+    # (relative) of the fp32 one, and its total disentanglement scores within disent_tolerance (absolute). The batches
+    # of data.val_iter should have the size of the served ones, since they are used for the latency measurements and
+    # the aggregate posterior of the mutual information estimates. Nothing is written to the models' summaries.
+    report = {}
+    for name, model in [('fp32', fp32_model), ('int8', int8_model)]:
+        model.eval()
+        _, _, rec, _ = model.collect_stats(data.val_iter, log=False)
+        data.reinit_iterator('valid')
+        dec_disent, enc_disent, _, _ = model.get_disentanglement_summaries2(data.val_iter, n_disentanglement_samples,
+                                                                            log=False)
+        data.reinit_iterator('valid')
+        with torch.no_grad():
+            text = next(iter(data.val_iter)).text
+            data.reinit_iterator('valid')
+            latency = _inference_latency(model, text, n_latency_repeats)
+        report[name] = {'rec': rec, 'dec_disent': sum(dec_disent.values()), 'enc_disent': sum(enc_disent.values()),
+                        'latency': latency}
+
+    fp32, int8 = report['fp32'], report['int8']
+    report['rec_rel_diff'] = abs(int8['rec'] - fp32['rec']) / abs(fp32['rec'])
+    report['dec_disent_diff'] = abs(int8['dec_disent'] - fp32['dec_disent'])
+    report['enc_disent_diff'] = abs(int8['enc_disent'] - fp32['enc_disent'])
+    report['speedup'] = fp32['latency'] / int8['latency']
+    report['accepted'] = report['rec_rel_diff'] <= rec_tolerance and report['dec_disent_diff'] <= disent_tolerance \
+        and report['enc_disent_diff'] <= disent_tolerance
+    print("Reconstruction: fp32 {:.4f}, int8 {:.4f} (relative difference {:.2%})".format(fp32['rec'], int8['rec'],
+                                                                                       report['rec_rel_diff']))
+    print("Disentanglement (decoder/encoder): fp32 {:.4f}/{:.4f}, int8 {:.4f}/{:.4f}".format(
+        fp32['dec_disent'], fp32['enc_disent'], int8['dec_disent'], int8['enc_disent']))
+    print("Encode/decode latency: fp32 {:.1f}ms, int8 {:.1f}ms (x{:.2f})".format(
+        fp32['latency'] * 1000, int8['latency'] * 1000, report['speedup']))
+    print("Quantized model {}".format("accepted" if report['accepted'] else "REJECTED"))
+    return report
@@ -0,0 +1,269 @@
+# This file implements a local inference service for DisentanglementTransformerVAE models. Concurrent requests are
+# merged into micro-batches, which are run on the model by a single worker thread, and served over a minimal HTTP/JSON
+# interface (on a TCP port or a Unix socket).
+import asyncio
+import json
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+DECODING_OPTIONS = {'strategy': str, 'temperature': float, 'top_k': int, 'top_p': float, 'beam_size': int,
+                    'gen_len': int}
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+# ================================================== MICRO-BATCHING ====================================================
+
+class EndpointStats:
+    def __init__(self, window=1000):
+        self.n_requests = 0
+        self.n_batches = 0
+        self.busy_time = 0.
+        # Latencies of the last window requests
+        self.latencies = deque(maxlen=window)
+        self.start_time = time.perf_counter()
+
+    def record_batch(self, latencies, busy_time):
+        self.n_requests += len(latencies)
+        self.n_batches += 1
+        self.busy_time += busy_time
+        self.latencies.extend(latencies)
+
+    def summary(self):
+        latencies = np.array(self.latencies) * 1000 if len(self.latencies) else np.zeros(1)
+        return {'requests': self.n_requests, 'batches': self.n_batches,
+                'mean_batch_size': self.n_requests / max(self.n_batches, 1),
+                'throughput_rps': self.n_requests / (time.perf_counter() - self.start_time),
+                'model_throughput_rps': self.n_requests / self.busy_time if self.busy_time else 0.,
+                'latency_ms': {'mean': float(latencies.mean()), 'p50': float(np.percentile(latencies, 50)),
+                               'p95': float(np.percentile(latencies, 95)), 'p99': float(np.percentile(latencies, 99))}}
+
+
+class MicroBatcher:
+    def __init__(self, process_batch, executor, max_batch_size=64, max_wait=0.01, stats=None):
+        # process_batch maps a list of request payloads to the list of their results. It is run in executor, so that
+        # the event loop keeps accepting requests (which make the next batch) while a batch is being processed.
+        self.process_batch = process_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = stats
+        self.queue = None
+        self.worker = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self._run())
+
+    async def submit(self, payload):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((payload, future, time.perf_counter()))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            # Waiting for a first request, then collecting the others until the batch is full or the deadline is passed
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch,
+                                                     [payload for payload, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            for (_, future, _), result in zip(batch, results):
+                # Futures of disconnected clients are already cancelled
+                if not future.done():
+                    future.set_result(result)
+            if self.stats is not None:
+                self.stats.record_batch([end - submitted for _, _, submitted in batch], end - start)
+
+
+# ================================================= INFERENCE SERVICE ==================================================
+
+class InferenceService:
+    def __init__(self, model, max_batch_size=64, max_wait=0.01):
+        self.model = model
+        self.h_params = model.h_params
+        self.vocab_index = model.index[model.generated_v]
+        self.z_names = ['z{}'.format(i + 1) for i in range(len(self.h_params.n_latents))]
+        # The model keeps its intermediate values as attributes, so all the batches go through a single worker thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {}
+        self.batchers = {}
+        for name, process_batch in [('encode', self._encode_batch), ('decode', self._decode_batch),
+                                    ('swap', self._swap_batch), ('interpolate', self._interpolate_batch)]:
+            self.stats[name] = EndpointStats()
+            self.batchers[name] = MicroBatcher(process_batch, self.executor, max_batch_size=max_batch_size,
+                                               max_wait=max_wait, stats=self.stats[name])
+
+    def start(self):
+        for batcher in self.batchers.values():
+            batcher.start()
+
+    # ------------------------------------------------ Model calls ----------------------------------------------------
+    def _tokenize(self, sentences):
+        # Mirrors the training data fields: lower-cased, <go> and <eos> delimited, padded to max_len
+        stoi, max_len = self.vocab_index.stoi, self.h_params.max_len
+        pad, unk = stoi['<pad>'], stoi['<unk>']
+        tokens = torch.full((len(sentences), max_len), pad, dtype=torch.long)
+        for i, sentence in enumerate(sentences):
+            ids = [stoi['<go>']] + [stoi.get(w, unk) for w in sentence.lower().split()][:max_len - 2] + [stoi['<eos>']]
+            tokens[i, :len(ids)] = torch.tensor(ids)
+        return tokens.to(self.h_params.device)
+
+    def _encode(self, sentences):
+        return self.model.encode(self._tokenize(sentences), mode='mean')
+
+    def _decode(self, z_input, options):
+        # Rows sharing the same decoding options are decoded together
+        text = [None] * z_input[self.z_names[0]].shape[0]
+        groups = defaultdict(list)
+        for i, row_options in enumerate(options):
+            groups[tuple(sorted(row_options.items()))].append(i)
+        for row_options, rows in groups.items():
+            index = torch.tensor(rows, device=self.h_params.device)
+            group_text, _ = self.model.generate(z_input={k: v.index_select(0, index) for k, v in z_input.items()},
+                                                **dict(row_options))
+            for i, t in zip(rows, group_text):
+                text[i] = t
+        return text
+
+    def _encode_batch(self, payloads):
+        with torch.no_grad():
+            z = self._encode([p['sentence'] for p in payloads])
+        return [{'z': {k: v[i].tolist() for k, v in z.items()}} for i in range(len(payloads))]
+
+    def _decode_batch(self, payloads):
+        with torch.no_grad():
+            z = {name: torch.tensor([p['z'][name] for p in payloads], device=self.h_params.device)
+                 for name in self.z_names}
+            text = self._decode(z, [p['options'] for p in payloads])
+        return [{'text': t} for t in text]
+
+    def _swap_batch(self, payloads):
+        # Replaces, in the latent vectors of each source sentence, the slices of the given latent indices with those
+        # of the target sentence
+        n = len(payloads)
+        with torch.no_grad():
+            z = self._encode([p['source'] for p in payloads] + [p['target'] for p in payloads])
+            swap_masks = {name: torch.zeros((n, z[name].shape[-1]), dtype=torch.bool, device=self.h_params.device)
+                          for name in self.z_names}
+            for i, p in enumerate(payloads):
+                for id in p['latent_ids']:
+                    z_number, start, end = self.model._latent_id_to_slice(id)
+                    swap_masks[self.z_names[z_number]][i, start:end] = True
+            z = {k: torch.where(swap_masks[k], v[n:], v[:n]) for k, v in z.items()}
+            text = self._decode(z, [p['options'] for p in payloads])
+        return [{'text': text[i], 'z': {k: v[i].tolist() for k, v in z.items()}} for i in range(n)]
+
+    def _interpolate_batch(self, payloads):
+        # Decodes n_steps evenly spaced points between the latent vectors of each source and target sentences
+        n = len(payloads)
+        with torch.no_grad():
+            z = self._encode([p['source'] for p in payloads] + [p['target'] for p in payloads])
+            rows = torch.cat([torch.full((p['n_steps'],), i, dtype=torch.long) for i, p in enumerate(payloads)])
+            alphas = torch.cat([torch.linspace(0, 1, p['n_steps']) for p in payloads]).unsqueeze(-1)
+            rows, alphas = rows.to(self.h_params.device), alphas.to(self.h_params.device)
+            z = {k: (1 - alphas) * v[:n][rows] + alphas * v[n:][rows] for k, v in z.items()}
+            text = self._decode(z, [p['options'] for p in payloads for _ in range(p['n_steps'])])
+        results, offset = [], 0
+        for p in payloads:
+            results.append({'text': text[offset:offset + p['n_steps']]})
+            offset += p['n_steps']
+        return results
+
+    # ------------------------------------------------ Request parsing ------------------------------------------------
+    def _parse_request(self, endpoint, body):
+        # Validates request bodies before they are batched, so that a malformed request doesn't fail its whole batch
+        n_ids = sum(self.h_params.n_latents)
+        options = {k: DECODING_OPTIONS[k](v) for k, v in body.get('options', {}).items()}
+        assert options.get('strategy', 'greedy') in ('greedy', 'sample', 'beam'), "Unknown decoding strategy"
+        if endpoint == 'encode':
+            return {'sentence': str(body['sentence'])}
+        elif endpoint == 'decode':
+            for name in self.z_names:
+                z_size = self.model.gen_bn.name_to_v[name].size
+                assert len(body['z'][name]) == z_size, "{} must be of size {}".format(name, z_size)
+            return {'z': {name: [float(v) for v in body['z'][name]] for name in self.z_names}, 'options': options}
+        elif endpoint == 'swap':
+            latent_ids = [int(id) for id in body['latent_ids']]
+            assert all(0 <= id < n_ids for id in latent_ids), "Latent indices must be in [0, {}[".format(n_ids)
+            return {'source': str(body['source']), 'target': str(body['target']), 'latent_ids': latent_ids,
+                    'options': options}
+        elif endpoint == 'interpolate':
+            n_steps = int(body.get('n_steps', 5))
+            assert n_steps > 1, "n_steps must be at least 2"
+            return {'source': str(body['source']), 'target': str(body['target']), 'n_steps': n_steps,
+                    'options': options}
+        else:
+            raise LookupError(endpoint)
+
+    def metrics(self):
+        return {name: stats.summary() for name, stats in self.stats.items()}
+
+    # ---------------------------------------------------- HTTP -------------------------------------------------------
+    async def dispatch(self, method, path, body):
+        endpoint = path.strip('/')
+        if method == 'GET' and endpoint == 'metrics':
+            return 200, self.metrics()
+        if method != 'POST' or endpoint not in self.batchers:
+            return 404, {'error': 'Unknown route {} {}'.format(method, path)}
+        try:
+            payload = self._parse_request(endpoint, json.loads(body or b'{}'))
+        except (AssertionError, KeyError, TypeError, ValueError) as e:
+            return 400, {'error': '{}: {}'.format(type(e).__name__, e)}
+        try:
+            return 200, await self.batchers[endpoint].submit(payload)
+        except Exception as e:
+            return 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1')
+                if line in ('\r\n', '\n', ''):
+                    break
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, response = await self.dispatch(method, path, body)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, response = 400, {'error': 'Malformed HTTP request: {}'.format(e)}
+        content = json.dumps(response).encode()
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, HTTP_REASONS[status], len(content)).encode() + content)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+async def serve(service, host='127.0.0.1', port=8000, unix_socket=None):
+    service.start()
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(service.handle_connection, path=unix_socket)
+    else:
+        server = await asyncio.start_server(service.handle_connection, host, port)
+    print("Serving on", unix_socket or '{}:{}'.format(host, port))
+    async with server:
+        await server.serve_forever()